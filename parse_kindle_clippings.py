@@ -1,23 +1,55 @@
 from typing import *
 import json
 
-from util.clippingsitem import ClippingsItem
+from util.clippingsitem import ClippingsItem, CLIPPINGS_FILENAME, parse_clippings_file
 from util.export import (
 	sort_clippings_by_book, read_and_save_json, read_and_save_bybook_md,
 )
 
+from util.pipeline import (
+	sync,
+)
+
+from util.search import (
+	search_clippings, search_index_update,
+)
+
 from util.zotero import (
 	zotero_upload_all,
 )
 
+from util.zotero_plan import (
+	zotero_plan, zotero_apply,
+)
+
+from util.archive import (
+	compact_clippings, archive_query,
+)
+
+from util.server import (
+	serve,
+)
+
 
 if __name__ == "__main__":
 	import fire
 	fire.Fire({
-		'data_list' : lambda fn='../data.json' : read_and_save_json(fn),
-		'data_sorted' : lambda fn='../data.json' : read_and_save_json(fn, data_converter=sort_clippings_by_book),
+		'data_list' : lambda fn='../data.json', file_in=CLIPPINGS_FILENAME : read_and_save_json(
+			fn, data_reader=lambda : parse_clippings_file(file_in),
+		),
+		'data_sorted' : lambda fn='../data.json', file_in=CLIPPINGS_FILENAME : read_and_save_json(
+			fn, data_reader=lambda : parse_clippings_file(file_in), data_converter=sort_clippings_by_book,
+		),
 		'md_sorted' : read_and_save_bybook_md,
 		'zotero_upload' : zotero_upload_all,
+		'zotero_plan' : zotero_plan,
+		'zotero_apply' : zotero_apply,
+		'sync' : sync,
+		'search' : search_clippings,
+		'search_index' : search_index_update,
+		'compact' : compact_clippings,
+		'archive' : archive_query,
+		'serve' : serve,
 	})
 
 
@@ -0,0 +1,339 @@
+"""compressed, append-only archive of clippings moved off the kindle
+
+`My Clippings.txt` on the kindle only ever grows. `compact_clippings` moves entries which
+have already been ingested into gzipped archive segments in `ARCHIVE_DIR`, and rewrites
+the device file with only the remaining (recent) entries.
+
+the archive directory holds:
+ - `segment_NNNNN.txt.gz`: raw entries, byte for byte as they were in the device file.
+   segments are written once and never modified
+ - `index.json`: for each segment, the device file it was compacted from (`source`), its
+   number of items and date range, overall and per book. the index is the source of
+   truth: a segment not listed in it was left by an interrupted run, and is ignored
+ - `fingerprints.txt`: the segment and `clippings_fingerprint` of every archived entry,
+   one per line. rebuilt from the indexed segments if it does not match the index
+
+queries by book or date only decompress the segments whose index entry overlaps them.
+since segments are in the clippings file format, they can also be passed anywhere a
+clippings file is accepted. a compacted file is automatically read together with its
+segments, see `expand_clippings_filenames`, so exports stay complete.
+"""
+
+from typing import *
+import gzip
+import hashlib
+import json
+import os
+import re
+import time
+
+from util.clippingsitem import (
+	ClippingsItem, CLIPPINGS_FILENAME, ARCHIVE_DIR, ARCHIVE_INDEX_FILE,
+	clippings_fingerprint, archive_source_path,
+)
+from util.export import DATA_EXPORT_PATH
+from util.json_serialize import arbit_json_serialize
+from util.search import parse_date_arg
+from util.tokenizer import LazyClippingsItem, iter_clippings_buffer, iter_clippings_spans
+
+ARCHIVE_FINGERPRINTS_FILE : str = 'fingerprints.txt'
+
+# entries newer than this many days are kept on the device
+ARCHIVE_KEEP_DAYS : int = 30
+
+_SEGMENT_REGEX : Pattern = re.compile(r'^segment_(\d+)\.txt\.gz$')
+
+
+def _atomic_write(path : str, content : bytes) -> None:
+	"""write `content` to `path` via a temporary file in the same directory, so `path` is never partially written"""
+	tmp_path : str = path + f'.{os.getpid()}.tmp'
+	with open(tmp_path, 'wb') as f:
+		f.write(content)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(tmp_path, path)
+
+
+def archive_index_load(archive_dir : str = ARCHIVE_DIR) -> dict:
+	"""load the archive index, or an empty one if the archive does not exist yet"""
+	path : str = os.path.join(archive_dir, ARCHIVE_INDEX_FILE)
+	if not os.path.exists(path):
+		return {'segments' : list()}
+	with open(path, 'r') as f:
+		return json.load(f)
+
+
+def archive_fingerprints_load(
+		archive_dir : str = ARCHIVE_DIR,
+		source : Optional[str] = None,
+	) -> Set[str]:
+	"""fingerprints of the clippings in the indexed segments compacted from `source` (all segments if `None`)
+
+	read from the fingerprints file, which is rebuilt from the segments if it does not
+	match the index (e.g. a run was interrupted while appending to it)
+	"""
+	index : dict = archive_index_load(archive_dir)
+	segment_sources : Dict[str, str] = { x['file'] : x['source'] for x in index['segments'] }
+	path : str = os.path.join(archive_dir, ARCHIVE_FINGERPRINTS_FILE)
+
+	# `(segment, fingerprint)` pairs. a partially written last line has no valid sha1
+	entries : Set[Tuple[str, str]] = set()
+	if os.path.exists(path):
+		with open(path, 'r') as f:
+			entries = {
+				tuple(parts)
+				for parts in (line.split() for line in f)
+				if (len(parts) == 2) and (parts[0] in segment_sources) and (len(parts[1]) == 40)
+			}
+
+	if len(entries) != sum(x['n_items'] for x in index['segments']):
+		print(f'  archive fingerprints do not match the index, rebuilding them from {len(index["segments"])} segments')
+		entries = set()
+		for segment in index['segments']:
+			with gzip.open(os.path.join(archive_dir, segment['file']), 'rb') as f:
+				entries.update(
+					(segment['file'], clippings_fingerprint(item.to_item()))
+					for item in iter_clippings_buffer(f.read())
+				)
+		_atomic_write(path, ''.join( f'{seg} {fp}\n' for seg, fp in sorted(entries) ).encode('utf-8'))
+
+	return {
+		fp
+		for seg, fp in entries
+		if (source is None) or (segment_sources[seg] == source)
+	}
+
+
+def _new_segment_filename(archive_dir : str, index : dict) -> str:
+	"""name for a new segment, numbered after every segment in the index or on disk"""
+	existing : List[str] = [ x['file'] for x in index['segments'] ]
+	if os.path.isdir(archive_dir):
+		existing.extend(os.listdir(archive_dir))
+	numbers : List[int] = [
+		int(m.group(1))
+		for m in map(_SEGMENT_REGEX.match, existing)
+		if m is not None
+	]
+	return f'segment_{max(numbers, default = 0) + 1:05d}.txt.gz'
+
+
+def _segment_overlaps(
+		segment : dict,
+		title : Optional[str],
+		date_from : Optional[int],
+		date_to : Optional[int],
+	) -> bool:
+	"""whether a segment may contain clippings of `title` in `[date_from, date_to)`, from its index entry alone"""
+	ranges : dict = segment
+	if title is not None:
+		if title not in segment['books']:
+			return False
+		ranges = segment['books'][title]
+	if (date_from is not None) and (ranges['date_max'] < date_from):
+		return False
+	if (date_to is not None) and (ranges['date_min'] >= date_to):
+		return False
+	return True
+
+
+def archive_segments(
+		archive_dir : str = ARCHIVE_DIR,
+		title : Optional[str] = None,
+		date_from : Union[None, int, str] = None,
+		date_to : Union[None, int, str] = None,
+	) -> List[str]:
+	"""paths of the segments which may contain clippings of `title` dated in `[date_from, date_to)`, oldest first"""
+	date_from, date_to = parse_date_arg(date_from), parse_date_arg(date_to)
+	return [
+		os.path.join(archive_dir, segment['file'])
+		for segment in archive_index_load(archive_dir)['segments']
+		if _segment_overlaps(segment, title, date_from, date_to)
+	]
+
+
+def iter_archive(
+		archive_dir : str = ARCHIVE_DIR,
+		title : Optional[str] = None,
+		date_from : Union[None, int, str] = None,
+		date_to : Union[None, int, str] = None,
+	) -> Iterator[ClippingsItem]:
+	"""iterate over archived clippings of `title` (all books if `None`) dated in `[date_from, date_to)`, without merging notes
+
+	only the segments selected by `archive_segments` are decompressed
+	"""
+	date_from, date_to = parse_date_arg(date_from), parse_date_arg(date_to)
+	for path in archive_segments(archive_dir, title, date_from, date_to):
+		with gzip.open(path, 'rb') as f:
+			buf : bytes = f.read()
+		for item in iter_clippings_buffer(buf):
+			if (title is not None) and (item.title != title):
+				continue
+			if (date_from is not None) and (item.date_unix < date_from):
+				continue
+			if (date_to is not None) and (item.date_unix >= date_to):
+				continue
+			yield item.to_item()
+
+
+def _export_checkpoint(checkpoint_json : Optional[str]) -> Optional[int]:
+	"""date of the newest clipping in an exported json, `None` if there is no export"""
+	if (checkpoint_json is None) or (not os.path.exists(checkpoint_json)):
+		return None
+	with open(checkpoint_json, 'r') as f:
+		data : Union[list, dict] = json.load(f)
+	# either a flat list (`data_list`) or grouped by book (`data_sorted`, `md_sorted`)
+	items : Iterable[dict] = data if isinstance(data, list) else ( x for v in data.values() for x in v )
+	return max(( x['date_unix'] for x in items ), default = None)
+
+
+def _segment_entry(filename : str, source : str, content : bytes, items : List[LazyClippingsItem]) -> dict:
+	"""index entry for a new segment compacted from `source`"""
+	books : Dict[str, dict] = dict()
+	for item in items:
+		if item.title not in books:
+			books[item.title] = {
+				'author' : item.author,
+				'n_items' : 0,
+				'date_min' : item.date_unix,
+				'date_max' : item.date_unix,
+			}
+		book : dict = books[item.title]
+		book['n_items'] += 1
+		book['date_min'] = min(book['date_min'], item.date_unix)
+		book['date_max'] = max(book['date_max'], item.date_unix)
+
+	return {
+		'file' : filename,
+		'source' : source,
+		'created' : int(time.time()),
+		'sha256' : hashlib.sha256(content).hexdigest(),
+		'n_items' : len(items),
+		'date_min' : min(x.date_unix for x in items),
+		'date_max' : max(x.date_unix for x in items),
+		'books' : books,
+	}
+
+
+def compact_clippings(
+		file_in : str = CLIPPINGS_FILENAME,
+		keep_days : int = ARCHIVE_KEEP_DAYS,
+		checkpoint_json : Optional[str] = DATA_EXPORT_PATH,
+		dry_run : bool = False,
+	) -> None:
+	"""move ingested entries of `file_in` into a new segment in `ARCHIVE_DIR`, and rewrite `file_in` with the rest
+
+	the archive is always `ARCHIVE_DIR`, since that is where reading `file_in` looks for
+	its segments. an entry is moved if it is already in a segment of `file_in`, or if it is both older than
+	`keep_days` and no newer than the newest clipping in `checkpoint_json` (the last
+	export, so it has been ingested). without an export, only entries already in the
+	archive are removed from `file_in`. each device file has its own segments, so the
+	same clipping on two kindles is archived for each
+
+	the segment, then the index, then the fingerprints are written before `file_in` is
+	rewritten, and all files are replaced atomically. if interrupted, the next run finds
+	the moved entries in the archive by fingerprint, and removes them from `file_in`
+	without archiving them twice. segments record `file_in` as their source, so that later
+	reads of it include them (see `expand_clippings_filenames`)
+
+	### Parameters:
+	 - `file_in : str`
+	   the clippings file on the device
+	   (defaults to `CLIPPINGS_FILENAME`)
+	 - `keep_days : int`
+	   entries newer than this are always kept in `file_in`
+	   (defaults to `ARCHIVE_KEEP_DAYS`)
+	 - `checkpoint_json : Optional[str]`
+	   exported json marking what has been ingested, see above
+	   (defaults to `DATA_EXPORT_PATH`)
+	 - `dry_run : bool`
+	   only print what would be done
+	   (defaults to `False`)
+	"""
+
+	stat_before : os.stat_result = os.stat(file_in)
+	with open(file_in, 'rb') as f:
+		buf : bytes = f.read()
+
+	checkpoint : Optional[int] = _export_checkpoint(checkpoint_json)
+	cutoff : Optional[int] = None
+	if checkpoint is not None:
+		cutoff = min(checkpoint, int(time.time()) - keep_days * 24 * 60 * 60)
+
+	source : str = archive_source_path(file_in)
+	archived_fps : Set[str] = archive_fingerprints_load(ARCHIVE_DIR, source)
+
+	keep : List[bytes] = list()
+	to_archive : List[bytes] = list()
+	to_archive_items : List[LazyClippingsItem] = list()
+	to_archive_fps : List[str] = list()
+	n_duplicate : int = 0
+	for start, stop, item in iter_clippings_spans(buf):
+		fp : str = clippings_fingerprint(item.to_item())
+		if fp in archived_fps:
+			n_duplicate += 1
+		elif (cutoff is not None) and (item.date_unix <= cutoff):
+			# a clipping can appear twice in the same file, only archive it once
+			archived_fps.add(fp)
+			to_archive.append(buf[start:stop])
+			to_archive_items.append(item)
+			to_archive_fps.append(fp)
+		else:
+			keep.append(buf[start:stop])
+
+	print(f'# {len(to_archive)} entries to archive, {n_duplicate} already archived, {len(keep)} kept in "{file_in}"')
+	if dry_run or not (to_archive or n_duplicate):
+		return
+
+	# write the segment, then the index (which makes the segment part of the archive),
+	# then the fingerprints. the fingerprints are rebuilt if the last step is interrupted
+	if to_archive:
+		os.makedirs(ARCHIVE_DIR, exist_ok = True)
+		index : dict = archive_index_load(ARCHIVE_DIR)
+		filename : str = _new_segment_filename(ARCHIVE_DIR, index)
+		content : bytes = b''.join(to_archive)
+		_atomic_write(os.path.join(ARCHIVE_DIR, filename), gzip.compress(content, mtime = 0))
+
+		index['segments'].append(_segment_entry(filename, source, content, to_archive_items))
+		_atomic_write(
+			os.path.join(ARCHIVE_DIR, ARCHIVE_INDEX_FILE),
+			json.dumps(index, indent = '\t').encode('utf-8'),
+		)
+
+		with open(os.path.join(ARCHIVE_DIR, ARCHIVE_FINGERPRINTS_FILE), 'a') as f:
+			f.write(''.join( f'{filename} {fp}\n' for fp in to_archive_fps ))
+			f.flush()
+			os.fsync(f.fileno())
+		print(f'  archived {len(to_archive)} entries to "{filename}"')
+
+	# rewrite the device file, unless the kindle wrote to it in the meantime
+	stat_after : os.stat_result = os.stat(file_in)
+	if (stat_after.st_size, stat_after.st_mtime_ns) != (stat_before.st_size, stat_before.st_mtime_ns):
+		print(f'  WARNING: "{file_in}" changed while compacting, not rewriting it. run `compact` again')
+		return
+	_atomic_write(file_in, b''.join(keep))
+	print(f'  rewrote "{file_in}", {len(buf)} -> {sum(len(x) for x in keep)} bytes')
+
+
+def archive_query(
+		title : Optional[str] = None,
+		date_from : Union[None, int, str] = None,
+		date_to : Union[None, int, str] = None,
+		archive_dir : str = ARCHIVE_DIR,
+		json_out : Optional[str] = None,
+	) -> None:
+	"""print (or save to `json_out`) archived clippings of a book and/or date range, see `iter_archive`"""
+	n_segments : int = len(archive_segments(archive_dir, title, date_from, date_to))
+	items : List[ClippingsItem] = list(iter_archive(archive_dir, title, date_from, date_to))
+
+	if json_out is not None:
+		with open(json_out, 'w') as f:
+			json.dump(arbit_json_serialize(items), f, indent = 4)
+	else:
+		for item in items:
+			print(f'"{item.title}" by "{item.author}", location {item.location}, {item.date}')
+			if item.text_highlight:
+				print(f'    > {item.text_highlight}')
+			if item.text_note:
+				print(f'    note: {item.text_note}')
+
+	print(f'# {len(items)} clippings from {n_segments} segments')
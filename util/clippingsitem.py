@@ -1,6 +1,13 @@
 from typing import *
 import json
 import datetime
+import collections
+import glob
+import gzip
+import hashlib
+import marshal
+import multiprocessing
+import os
 
 ClippingsType = Literal["Highlight", "Note", "Note_Merged"]
 ClippingsItem = NamedTuple('ClippingsItem', [
@@ -16,6 +23,18 @@ ClippingsItem = NamedTuple('ClippingsItem', [
 
 CLIPPINGS_FILENAME : str = "../My Clippings.txt"
 
+# bump when the parsing output changes in a way not reflected in this file's source
+PARSER_VERSION : str = '1'
+PARSE_CACHE_DIR : str = '../.clippings_cache/'
+PARSE_CACHE_MAX_ENTRIES : int = 8
+
+# below this total size, starting worker processes costs more than parsing in-process
+PARSE_PARALLEL_MIN_BYTES : int = 32 * 1024 * 1024
+
+# clippings moved off the device by `compact`, see `util.archive`
+ARCHIVE_DIR : str = '../clippings_archive/'
+ARCHIVE_INDEX_FILE : str = 'index.json'
+
 MARKERS : Dict[str,str] = {
 	'meta_split' : '|',
 	'meta_type_prefix' : '- Your ',
@@ -25,37 +44,15 @@ MARKERS : Dict[str,str] = {
 
 
 
-def parse_ClippingsItem(item_raw : str) -> ClippingsItem:
-	"""parses a single clippings item into a named tuple
-
-	example clipping text:
-	```
-	*How We Learn (Stanislas Dehaene)
-	- Your Highlight on Location 3824-3826 | Added on Wednesday, December 2, 2021 10:05:32 PM
-
-	The new idea is that during sleep, our brain works in the opposite direction: from top to bottom. During the night, we use our generative models to synthesize new, unanticipated images, and part of our brain trains itself on this array of images created from scratch.
-	```
-
-	- the first line is title and author (`*` is a 3-byte sequence that we ignore, idk what it does)
-	- the second line is the type, location, and date of highlight
-	- the third line is empty
-	- the fourth line is the text
-	- the fifth line is empty
-	
-	### Parameters:
-	 - `item_raw : str`   
-	
-	### Returns:
-	 - `ClippingsItem` 
-	"""
+# the kindle starts every title line with a utf-8 byte order mark
+BOM : str = '\ufeff'
 
-	line_titleauthor, line_meta, line_text = [ line.strip() for line in item_raw.split("\n") if line.strip() != '' ]
 
-	# check validity of the item
-	assert line_meta.startswith(MARKERS['meta_type_prefix']), f"`line_meta` should start with `- Your `, got {line_meta}"
+def parse_titleauthor(line_titleauthor : str) -> Tuple[str, str]:
+	"""parses the first line of a clipping into `(title, author)`, stripping the byte order mark if present"""
 
-	# remove weird bytes at the begginning of `line_titleauthor`
-	line_titleauthor = line_titleauthor[3:]
+	# remove the byte order mark at the begginning of `line_titleauthor`
+	line_titleauthor = line_titleauthor.strip().lstrip(BOM).strip()
 
 	# first, just use the whole string as the title
 	title : str = line_titleauthor
@@ -78,7 +75,48 @@ def parse_ClippingsItem(item_raw : str) -> ClippingsItem:
 
 	except (IndexError,ValueError) as e:
 		print(f'caught exception when finding metadata: \n {author=}\t{title=}\n{e}')
-		
+
+	return title, author
+
+
+MONTHS : Dict[str, int] = {
+	month : idx + 1
+	for idx, month in enumerate([
+		'January', 'February', 'March', 'April', 'May', 'June',
+		'July', 'August', 'September', 'October', 'November', 'December',
+	])
+}
+
+
+def parse_date_unix(date : str) -> int:
+	"""convert a kindle date like `Wednesday, December 2, 2021 10:05:32 PM` (local time) to a unix timestamp
+
+	the fixed format is split by hand, since `strptime` dominates the parse time.
+	anything not in that format falls back to `strptime`
+	"""
+	try:
+		_, month, day, year, clock, ampm = date.split(' ')
+		hour, minute, second = clock.split(':')
+		hour_24 : int = int(hour) % 12 + (12 if ampm == 'PM' else 0)
+		if (ampm not in ('AM', 'PM')) or (not day.endswith(',')):
+			raise ValueError(date)
+		return int(datetime.datetime(
+			int(year), MONTHS[month], int(day[:-1]),
+			hour_24, int(minute), int(second),
+		).timestamp())
+	except (ValueError, KeyError):
+		return int(
+			datetime.datetime.strptime(date, "%A, %B %d, %Y %I:%M:%S %p").timestamp()
+		)
+
+
+def parse_meta(line_meta : str) -> Tuple[ClippingsType, str, str, int]:
+	"""parses the second line of a clipping into `(clip_type, location, date, date_unix)`"""
+
+	line_meta = line_meta.strip()
+
+	# check validity of the item
+	assert line_meta.startswith(MARKERS['meta_type_prefix']), f"`line_meta` should start with `- Your `, got {line_meta}"
 
 	# find the type 
 	clip_type : ClippingsType = (
@@ -87,9 +125,11 @@ def parse_ClippingsItem(item_raw : str) -> ClippingsItem:
 		.strip()
 	)
 
+	meta_parts : List[str] = line_meta.split(MARKERS['meta_split'])
+
 	# find the clipping location
 	location : str = (
-		line_meta.split(MARKERS['meta_split'])[0]
+		meta_parts[0]
 		.strip()
 		.split(' ')[-1]
 		.strip()
@@ -97,8 +137,7 @@ def parse_ClippingsItem(item_raw : str) -> ClippingsItem:
 
 	# find the date
 	date : str = (
-		line_meta
-		.split(MARKERS['meta_split'])[1]
+		meta_parts[1]
 		.strip()[len(MARKERS['meta_date_prefix']):]
 		.strip()
 	)
@@ -108,9 +147,39 @@ def parse_ClippingsItem(item_raw : str) -> ClippingsItem:
 	# `<weekday>, <month> <day>, <year> <hour>:<minute>:<second> <AM/PM>`
 	# example date:
 	# "Wednesday, December 2, 2021 10:05:32 PM"
-	date_unix : int = int(
-		datetime.datetime.strptime(date, "%A, %B %d, %Y %I:%M:%S %p").timestamp()
-	)
+	date_unix : int = parse_date_unix(date)
+
+	return clip_type, location, date, date_unix
+
+
+def parse_ClippingsItem(item_raw : str) -> ClippingsItem:
+	"""parses a single clippings item into a named tuple
+
+	example clipping text:
+	```
+	\ufeffHow We Learn (Stanislas Dehaene)
+	- Your Highlight on Location 3824-3826 | Added on Wednesday, December 2, 2021 10:05:32 PM
+
+	The new idea is that during sleep, our brain works in the opposite direction: from top to bottom. During the night, we use our generative models to synthesize new, unanticipated images, and part of our brain trains itself on this array of images created from scratch.
+	```
+
+	- the first line is title and author, starting with a byte order mark (`\ufeff`, 3 bytes in utf-8)
+	- the second line is the type, location, and date of highlight
+	- the third line is empty
+	- the fourth line is the text
+	- the fifth line is empty
+	
+	### Parameters:
+	 - `item_raw : str`   
+	
+	### Returns:
+	 - `ClippingsItem` 
+	"""
+
+	line_titleauthor, line_meta, line_text = [ line.strip() for line in item_raw.split("\n") if line.strip() != '' ]
+
+	title, author = parse_titleauthor(line_titleauthor)
+	clip_type, location, date, date_unix = parse_meta(line_meta)
 
 	# find the text
 	text_highlight : Optional[str] = None
@@ -213,8 +282,73 @@ def merge_list_clip_items(data : List[ClippingsItem]) -> List[ClippingsItem]:
 
 
 
-def parse_clippings_file(filename : str = CLIPPINGS_FILENAME, merge : bool = True) -> List[ClippingsItem]:
-	"""parses a clippings file into a list of named tuples
+def iter_merge_clip_items(data : Iterable[ClippingsItem], window : int = 64) -> Iterator[ClippingsItem]:
+	"""streaming version of `merge_list_clip_items`, holding at most `window` items in memory
+
+	a note is only merged into a highlight among the `window` items before it. the kindle
+	writes a note right after its highlight, so this finds the same matches in practice.
+	the output order differs from `merge_list_clip_items`
+	"""
+	pending : Deque[ClippingsItem] = collections.deque()
+	for item in data:
+		assert item.clip_type in ['Highlight', 'Note'], f"all items should be of type `Highlight` or `Note`, got {item}"
+		found_match : bool = False
+		if item.clip_type == 'Note':
+			for idx, item_prev in enumerate(pending):
+				# make sure the item can still be augmented
+				if (item_prev.text_note is not None) or (item_prev.clip_type != 'Highlight'):
+					continue
+				if check_can_merge(item, item_prev):
+					pending[idx] = merge_note_highlight(item, item_prev)
+					found_match = True
+					break
+		if not found_match:
+			pending.append(item)
+
+		while len(pending) > window:
+			yield pending.popleft()
+
+	yield from pending
+
+
+def open_clippings_file(filename : str) -> TextIO:
+	"""open a clippings file for reading as text, decompressing it if it ends with `.gz` (as archive segments do)"""
+	if filename.endswith('.gz'):
+		return gzip.open(filename, 'rt', encoding = 'utf-8')
+	return open(filename, 'r', encoding = 'utf-8')
+
+
+def iter_clippings_file(filename : str) -> Iterator[ClippingsItem]:
+	"""parses a clippings file lazily, one item at a time, without merging notes"""
+	with open_clippings_file(filename) as f:
+		lines : List[str] = list()
+		for line in f:
+			if line.strip() != MARKERS['item_split']:
+				lines.append(line)
+				continue
+			item_raw : str = ''.join(lines)
+			lines = list()
+			if item_raw.strip():
+				yield parse_ClippingsItem(item_raw)
+
+		item_raw = ''.join(lines)
+		if item_raw.strip():
+			yield parse_ClippingsItem(item_raw)
+
+
+def parse_location_range(location : str) -> Tuple[int, int]:
+	"""parse a location string like `3824-3826` or `3826` into `(start, end)`, `(-1, -1)` if not numeric"""
+	parts : List[str] = location.split('-')
+	try:
+		start : int = int(parts[0])
+		end : int = int(parts[-1])
+	except ValueError:
+		return (-1, -1)
+	return (start, end)
+
+
+def parse_clippings_file_raw(filename : str) -> List[ClippingsItem]:
+	"""parses a single clippings file into a list of named tuples, without merging notes
 
 	### Parameters:
 	 - `filename : str`   
@@ -223,14 +357,295 @@ def parse_clippings_file(filename : str = CLIPPINGS_FILENAME, merge : bool = Tru
 	 - `List[ClippingsItem]` 
 	"""
 
-	with open(filename, 'r') as f:
-		data : List[ClippingsItem] = [
+	with open_clippings_file(filename) as f:
+		return [
 			parse_ClippingsItem(item)
 			for item in f.read().split(MARKERS['item_split'])
 			if item.strip()
 		]
+
+
+def clippings_fingerprint(item : ClippingsItem) -> str:
+	"""stable content fingerprint of a clipping, used to deduplicate across devices
+
+	only the title, author, location, date, and text are used -- so the same clipping
+	found in two different `My Clippings.txt` files has the same fingerprint
+	"""
+	return hashlib.sha1(
+		'\x1f'.join([
+			item.title,
+			item.author,
+			item.location,
+			str(item.date_unix),
+			item.text_highlight or '',
+			item.text_note or '',
+		]).encode('utf-8')
+	).hexdigest()
+
+
+def archive_source_path(filename : str) -> str:
+	"""normalized absolute path of a compacted file, as recorded in the archive index"""
+	return os.path.normpath(os.path.abspath(filename))
+
+
+def archived_segments_for(filename : str, archive_dir : str = ARCHIVE_DIR) -> List[str]:
+	"""paths of the archive segments compacted from `filename`, oldest first (see `util.archive`)"""
+	index_path : str = os.path.join(archive_dir, ARCHIVE_INDEX_FILE)
+	if not os.path.exists(index_path):
+		return list()
+	with open(index_path, 'r') as f:
+		index : dict = json.load(f)
+	source : str = archive_source_path(filename)
+	return [
+		os.path.join(archive_dir, segment['file'])
+		for segment in index['segments']
+		if segment['source'] == source
+	]
+
+
+def expand_clippings_filenames(
+		filenames : Union[str, Iterable[str]],
+		include_archive : bool = True,
+	) -> List[str]:
+	"""expand a filename, glob, or list of filenames/globs into a list of unique paths
+
+	globs which match nothing are kept as-is, so that a missing file still raises an error when opened.
+	if `include_archive`, a file which was compacted into `ARCHIVE_DIR` is preceded by its
+	archive segments, so the clippings moved off of it are still read
+	"""
+	if isinstance(filenames, str):
+		filenames = [filenames]
+
+	output : List[str] = list()
+	seen : Set[str] = set()
+
+	def _add(fname : str) -> None:
+		fname_norm : str = os.path.normpath(os.path.abspath(fname))
+		if fname_norm not in seen:
+			seen.add(fname_norm)
+			output.append(fname)
+
+	for pattern in filenames:
+		matches : List[str] = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+		for fname in (matches or [pattern]):
+			if include_archive:
+				for segment in archived_segments_for(fname):
+					_add(segment)
+			_add(fname)
+
+	return output
+
+
+def parse_clippings_files(
+		filenames : Union[str, Iterable[str]],
+		merge : bool = True,
+		n_workers : Optional[int] = None,
+	) -> List[ClippingsItem]:
+	"""parses several clippings files (or globs), deduplicating identical clippings across them
 	
+	clippings are deduplicated by `clippings_fingerprint`, keeping the first occurrence
+	(in the order the files are given). only unique clippings are kept in memory,
+	each file's results are discarded as soon as they have been deduplicated
+
+	### Parameters:
+	 - `filenames : Union[str, Iterable[str]]`   
+	   filenames or globs
+	 - `merge : bool`   
+	   whether to merge notes into highlights, after deduplication
+	   (defaults to `True`)
+	 - `n_workers : Optional[int]`   
+	   number of processes to parse with. if `None`, parses in-process unless the files
+	   total at least `PARSE_PARALLEL_MIN_BYTES`, then one per file up to the cpu count
+	   (defaults to `None`)
+	
+	### Returns:
+	 - `List[ClippingsItem]` 
+	"""
+
+	fnames : List[str] = expand_clippings_filenames(filenames)
+
+	if n_workers is None:
+		# missing files are left to raise when parsed
+		total_size : int = sum(os.path.getsize(x) for x in fnames if os.path.isfile(x))
+		if total_size >= PARSE_PARALLEL_MIN_BYTES:
+			n_workers = min(len(fnames), os.cpu_count() or 1)
+		else:
+			n_workers = 1
+
+	seen : Set[str] = set()
+	data : List[ClippingsItem] = list()
+
+	def _add_unique(items : List[ClippingsItem]) -> None:
+		for item in items:
+			fp : str = clippings_fingerprint(item)
+			if fp not in seen:
+				seen.add(fp)
+				data.append(item)
+
+	if n_workers <= 1:
+		for fname in fnames:
+			_add_unique(parse_clippings_file_raw(fname))
+	else:
+		with multiprocessing.Pool(n_workers) as pool:
+			# `imap` keeps the file order, so the first occurrence is deterministic
+			for items in pool.imap(parse_clippings_file_raw, fnames):
+				_add_unique(items)
+
 	if merge:
 		data = merge_list_clip_items(data)
 	
-	return data
\ No newline at end of file
+	return data
+
+
+# parse result cache
+# ==================================================
+
+_PARSER_FINGERPRINT : Optional[str] = None
+
+def parser_fingerprint() -> str:
+	"""hash of `PARSER_VERSION` and the source of this module, so the cache is invalidated when the parser changes"""
+	global _PARSER_FINGERPRINT
+	if _PARSER_FINGERPRINT is None:
+		with open(__file__, 'rb') as f:
+			_PARSER_FINGERPRINT = hashlib.sha256(PARSER_VERSION.encode('utf-8') + f.read()).hexdigest()
+	return _PARSER_FINGERPRINT
+
+
+def file_content_key(filename : str, cache_dir : str = PARSE_CACHE_DIR) -> Tuple[int, int, str]:
+	"""`(size, mtime_ns, sha256)` of a file
+
+	the content hash is remembered in `cache_dir/files.json`, and only recomputed
+	when the size or mtime of the file changes
+	"""
+	stat : os.stat_result = os.stat(filename)
+	path : str = os.path.abspath(filename)
+	index_path : str = os.path.join(cache_dir, 'files.json')
+
+	index : Dict[str, list] = dict()
+	if os.path.exists(index_path):
+		try:
+			with open(index_path, 'r') as f:
+				index = json.load(f)
+		except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+			index = dict()
+
+	known : Optional[list] = index.get(path, None)
+	if (known is not None) and (known[0] == stat.st_size) and (known[1] == stat.st_mtime_ns):
+		return tuple(known)
+
+	sha : hashlib._Hash = hashlib.sha256()
+	with open(filename, 'rb') as f:
+		for chunk in iter(lambda : f.read(1 << 20), b''):
+			sha.update(chunk)
+
+	key : Tuple[int, int, str] = (stat.st_size, stat.st_mtime_ns, sha.hexdigest())
+	index[path] = list(key)
+	tmp_path : str = index_path + f'.{os.getpid()}.tmp'
+	with open(tmp_path, 'w') as f:
+		json.dump(index, f)
+	os.replace(tmp_path, index_path)
+	return key
+
+
+def parse_cache_key(filenames : List[str], merge : bool, cache_dir : str = PARSE_CACHE_DIR) -> str:
+	"""cache key for parsing `filenames` (in order), from their contents, the parser, and `merge`"""
+	return hashlib.sha256(
+		json.dumps([
+			parser_fingerprint(),
+			merge,
+			[ file_content_key(fname, cache_dir) for fname in filenames ],
+		]).encode('utf-8')
+	).hexdigest()
+
+
+def parse_cache_load(key : str, cache_dir : str = PARSE_CACHE_DIR) -> Optional[List[ClippingsItem]]:
+	"""load a cached parse result, or `None` if not cached"""
+	path : str = os.path.join(cache_dir, key + '.marshal')
+	if not os.path.exists(path):
+		return None
+	try:
+		# `marshal.loads` on the whole file is much faster than `marshal.load` on the file object
+		with open(path, 'rb') as f:
+			return list(map(ClippingsItem._make, marshal.loads(f.read())))
+	except (EOFError, ValueError, TypeError):
+		# corrupted cache entry, just parse again
+		return None
+
+
+def parse_cache_save(key : str, data : List[ClippingsItem], cache_dir : str = PARSE_CACHE_DIR) -> None:
+	"""save a parse result, keeping only the `PARSE_CACHE_MAX_ENTRIES` most recent entries"""
+	path : str = os.path.join(cache_dir, key + '.marshal')
+	tmp_path : str = path + f'.{os.getpid()}.tmp'
+	with open(tmp_path, 'wb') as f:
+		# marshal only handles exact tuples, not namedtuples
+		f.write(marshal.dumps([ tuple(x) for x in data ]))
+	os.replace(tmp_path, path)
+
+	entries : List[str] = sorted(
+		(
+			os.path.join(cache_dir, x)
+			for x in os.listdir(cache_dir)
+			if x.endswith('.marshal')
+		),
+		key = os.path.getmtime,
+		reverse = True,
+	)
+	for old_path in entries[PARSE_CACHE_MAX_ENTRIES:]:
+		os.remove(old_path)
+
+
+def parse_clippings_file(
+		filename : Union[str, Iterable[str]] = CLIPPINGS_FILENAME,
+		merge : bool = True,
+		use_cache : bool = True,
+		cache_dir : str = PARSE_CACHE_DIR,
+	) -> List[ClippingsItem]:
+	"""parses a clippings file into a list of named tuples
+
+	if `filename` expands to several files (a glob or a list of filenames, or a file
+	compacted into the archive), they are all parsed and deduplicated via `parse_clippings_files`
+
+	the result is cached in `cache_dir`, keyed by the size, mtime and content hash of
+	the input files, the parser source, and `merge`. so parsing the same unchanged
+	file again only loads the cached result
+
+	### Parameters:
+	 - `filename : Union[str, Iterable[str]]`   
+	 - `merge : bool`   
+	   whether to merge notes into highlights
+	   (defaults to `True`)
+	 - `use_cache : bool`   
+	   (defaults to `True`)
+	 - `cache_dir : str`   
+	   (defaults to `PARSE_CACHE_DIR`)
+	
+	### Returns:
+	 - `List[ClippingsItem]` 
+	"""
+
+	# an iterator would be consumed by expanding it
+	if not isinstance(filename, str):
+		filename = list(filename)
+	fnames : List[str] = expand_clippings_filenames(filename)
+
+	cache_key : Optional[str] = None
+	# nothing to key an empty input on
+	if use_cache and fnames:
+		os.makedirs(cache_dir, exist_ok = True)
+		cache_key = parse_cache_key(fnames, merge, cache_dir)
+		data_cached : Optional[List[ClippingsItem]] = parse_cache_load(cache_key, cache_dir)
+		if data_cached is not None:
+			return data_cached
+
+	# decided on `fnames` only, so the result is the same for every input with the same cache key
+	if len(fnames) > 1:
+		data : List[ClippingsItem] = parse_clippings_files(filename, merge = merge)
+	else:
+		data = parse_clippings_file_raw(fnames[0]) if fnames else list()
+		if merge:
+			data = merge_list_clip_items(data)
+
+	if cache_key is not None:
+		parse_cache_save(cache_key, data, cache_dir)
+	
+	return data
@@ -8,6 +8,7 @@ from util.clippingsitem import (
 	CLIPPINGS_FILENAME,
 	parse_clippings_file,
 )
+from util.render import CompiledTemplate, get_template
 
 DATA_EXPORT_PATH : str = '../data.json'
 
@@ -192,10 +193,14 @@ def read_and_save_bybook_md(
 		file_in : str = CLIPPINGS_FILENAME, 
 		out_dir : str = '../notes/', 
 		json_out : Optional[str] = DATA_EXPORT_PATH,
+		fmt : str = 'md',
+		memory_budget : Optional[int] = None,
 	) -> None:
 	"""reads `file_in`, splits up by book, and saves as markdown to `out_dir/<filename>`
 	
-	[extended_summary]
+	each book is streamed to its file item by item using the template `fmt`.
+	if `memory_budget` is given, the clippings are grouped and sorted on disk
+	instead, see `util.external_sort.read_and_save_bybook_external`
 	
 	### Parameters:
 	 - `file_in : str`   
@@ -204,7 +209,20 @@ def read_and_save_bybook_md(
 	   (defaults to `'../notes/'`)
 	 - `json_out : Optional[str]`   
 	   (defaults to `None`)
+	 - `fmt : str`   
+	   name of a template in `util.render.TEMPLATES`: `md`, `html`, `csv`, or `org`
+	   (defaults to `'md'`)
+	 - `memory_budget : Optional[int]`   
+	   approximate bytes of clippings to hold in memory, unbounded if `None`
+	   (defaults to `None`)
 	"""
+	if memory_budget is not None:
+		# imported here, since `util.external_sort` depends on this module
+		from util.external_sort import read_and_save_bybook_external
+		read_and_save_bybook_external(file_in, out_dir, json_out, fmt = fmt, memory_budget = memory_budget)
+		return
+
+	template : CompiledTemplate = get_template(fmt)
 
 	# read and process data
 	data_list : List[ClippingsItem] = parse_clippings_file(file_in)
@@ -221,7 +239,7 @@ def read_and_save_bybook_md(
 	
 	# export to markdown
 	for title, items in data_bybook.items():
-		filename : str = out_dir + ClippingsItem_to_filename(items[0]) + '.md'
+		filename : str = out_dir + ClippingsItem_to_filename(items[0]) + template.extension
 		with open(filename, 'w', newline='\n') as f:
 			print(f'  saving {len(items)} notes from "{title}"')
-			f.write(ClippingsItem_lst_md(items))
\ No newline at end of file
+			template.render_to(items, f)
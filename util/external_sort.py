@@ -0,0 +1,229 @@
+"""memory-bounded grouping and sorting of clippings, for libraries larger than memory
+
+clippings are buffered in memory until `memory_budget` is exceeded, then the buffer is
+sorted by `(book, sort key)` and spilled to a temporary run file. at the end, the runs
+are k-way merged, giving every book's clippings in sorted order, one book at a time.
+"""
+
+from typing import *
+import heapq
+import itertools
+import json
+import os
+import pickle
+import tempfile
+import textwrap
+
+from util.json_serialize import arbit_json_serialize
+from util.clippingsitem import (
+	ClippingsItem, CLIPPINGS_FILENAME,
+	expand_clippings_filenames, iter_clippings_file, iter_merge_clip_items,
+	clippings_fingerprint, parse_location_range,
+)
+from util.export import ClippingsItem_to_filename, DATA_EXPORT_PATH
+from util.render import CompiledTemplate, get_template
+
+# default memory budget for buffered clippings, in bytes
+EXTERNAL_SORT_MEMORY_BUDGET : int = 64 * 1024 * 1024
+
+# rough per-item overhead of a `ClippingsItem` and its sort record, in bytes
+_ITEM_OVERHEAD : int = 400
+
+SortBy = Literal['date_unix', 'location']
+
+# a record in a run: (book index, sort key, sequence number, item as a plain tuple)
+_Record = Tuple[int, tuple, int, tuple]
+
+
+def _sort_key(item : ClippingsItem, sort_by : SortBy) -> tuple:
+	if sort_by == 'date_unix':
+		return (item.date_unix,)
+	elif sort_by == 'location':
+		return parse_location_range(item.location)
+	raise ValueError(f'unknown sort key {sort_by}, expected `date_unix` or `location`')
+
+
+def _item_size(item : ClippingsItem) -> int:
+	"""approximate memory used by an item"""
+	return _ITEM_OVERHEAD + sum(
+		len(x) for x in (item.title, item.author, item.location, item.date, item.text_highlight, item.text_note)
+		if x is not None
+	)
+
+
+def _write_run(records : List[_Record], tmp_dir : Optional[str]) -> str:
+	"""sort and write a run to a temporary file, returning its path"""
+	records.sort()
+	fd, path = tempfile.mkstemp(prefix = 'clippings_run_', suffix = '.pkl', dir = tmp_dir)
+	with os.fdopen(fd, 'wb') as f:
+		pickler : pickle.Pickler = pickle.Pickler(f, protocol = pickle.HIGHEST_PROTOCOL)
+		for record in records:
+			pickler.dump(record)
+			# the pickler memoizes every object it dumps, which would keep the whole run in memory
+			pickler.clear_memo()
+	return path
+
+
+def _read_run(path : str) -> Iterator[_Record]:
+	with open(path, 'rb') as f:
+		unpickler : pickle.Unpickler = pickle.Unpickler(f)
+		while True:
+			try:
+				yield unpickler.load()
+			except EOFError:
+				return
+
+
+def group_clippings_external(
+		clippings : Iterable[ClippingsItem],
+		memory_budget : int = EXTERNAL_SORT_MEMORY_BUDGET,
+		sort_by : SortBy = 'date_unix',
+		tmp_dir : Optional[str] = None,
+	) -> Iterator[Tuple[str, Iterator[ClippingsItem]]]:
+	"""group clippings by book title and sort each book, spilling to disk past `memory_budget` bytes
+
+	books are yielded in order of first appearance, like `sort_clippings_by_book`. within a
+	book, clippings are sorted by `sort_by`, ties keeping their input order. like
+	`itertools.groupby`, each book's iterator must be consumed before moving to the next book
+
+	### Parameters:
+	 - `clippings : Iterable[ClippingsItem]`
+	   consumed lazily
+	 - `memory_budget : int`
+	   approximate bytes of clippings to buffer before spilling a run to disk
+	   (defaults to `EXTERNAL_SORT_MEMORY_BUDGET`)
+	 - `sort_by : SortBy`
+	   `'date_unix'` or `'location'`
+	   (defaults to `'date_unix'`)
+	 - `tmp_dir : Optional[str]`
+	   where to write runs, the system default if `None`
+
+	### Returns:
+	 - `Iterator[Tuple[str, Iterator[ClippingsItem]]]`
+	"""
+	book_idx : Dict[str, int] = dict()
+	buffer : List[_Record] = list()
+	buffer_size : int = 0
+	run_paths : List[str] = list()
+
+	try:
+		for seq, item in enumerate(clippings):
+			idx : int = book_idx.setdefault(item.title, len(book_idx))
+			buffer.append((idx, _sort_key(item, sort_by), seq, tuple(item)))
+			buffer_size += _item_size(item)
+			if buffer_size > memory_budget:
+				run_paths.append(_write_run(buffer, tmp_dir))
+				buffer = list()
+				buffer_size = 0
+
+		# if nothing was spilled, everything fits in memory
+		if not run_paths:
+			buffer.sort()
+			merged : Iterable[_Record] = buffer
+		else:
+			if buffer:
+				run_paths.append(_write_run(buffer, tmp_dir))
+				buffer = list()
+			merged = heapq.merge(*[ _read_run(path) for path in run_paths ])
+
+		titles : List[str] = list(book_idx.keys())
+		for idx, records in itertools.groupby(merged, key = lambda x : x[0]):
+			yield (
+				titles[idx],
+				( ClippingsItem._make(record[3]) for record in records ),
+			)
+	finally:
+		for path in run_paths:
+			if os.path.exists(path):
+				os.remove(path)
+
+
+def iter_clippings_files(
+		filenames : Union[str, Iterable[str]] = CLIPPINGS_FILENAME,
+		merge : bool = True,
+		dedupe : bool = True,
+	) -> Iterator[ClippingsItem]:
+	"""lazily parse clippings files (or globs), optionally deduplicating and merging notes as they stream
+
+	deduplication keeps a set of fingerprints, so it uses memory proportional to the number of unique clippings
+	"""
+	fnames : List[str] = expand_clippings_filenames(filenames)
+	items : Iterable[ClippingsItem] = itertools.chain.from_iterable(
+		iter_clippings_file(fname) for fname in fnames
+	)
+
+	if dedupe and (len(fnames) > 1):
+		seen : Set[str] = set()
+		def _unique(items_in : Iterable[ClippingsItem]) -> Iterator[ClippingsItem]:
+			for item in items_in:
+				fp : str = clippings_fingerprint(item)
+				if fp not in seen:
+					seen.add(fp)
+					yield item
+		items = _unique(items)
+
+	if merge:
+		items = iter_merge_clip_items(items)
+
+	return iter(items)
+
+
+def read_and_save_bybook_external(
+		file_in : Union[str, Iterable[str]] = CLIPPINGS_FILENAME,
+		out_dir : str = '../notes/',
+		json_out : Optional[str] = DATA_EXPORT_PATH,
+		fmt : str = 'md',
+		memory_budget : int = EXTERNAL_SORT_MEMORY_BUDGET,
+		sort_by : SortBy = 'date_unix',
+		tmp_dir : Optional[str] = None,
+	) -> None:
+	"""memory-bounded version of `read_and_save_bybook_md`
+
+	the clippings are streamed from `file_in`, grouped with `group_clippings_external`,
+	and each book is written to its file (and to the json) as it is merged from disk.
+	in the json, each book's clippings are in `sort_by` order rather than file order
+	"""
+	template : CompiledTemplate = get_template(fmt)
+
+	f_json : Optional[TextIO] = open(json_out, 'w', newline='\n') if json_out is not None else None
+	try:
+		if f_json is not None:
+			f_json.write('{')
+
+		for n_book, (title, items) in enumerate(group_clippings_external(
+				iter_clippings_files(file_in),
+				memory_budget = memory_budget,
+				sort_by = sort_by,
+				tmp_dir = tmp_dir,
+			)):
+			# peek at the first item for the filename
+			first : ClippingsItem = next(items)
+			items = itertools.chain([first], items)
+
+			if f_json is not None:
+				f_json.write((',' if n_book else '') + f'\n    {json.dumps(title)}: [')
+				items = _tap_json(items, f_json)
+
+			filename : str = out_dir + ClippingsItem_to_filename(first) + template.extension
+			with open(filename, 'w', newline='\n') as f:
+				n_items : int = template.render_to(items, f, sort_clipitems = None)
+				print(f'  saving {n_items} notes from "{title}"')
+
+			if f_json is not None:
+				f_json.write('\n    ]')
+
+		if f_json is not None:
+			f_json.write('\n}')
+	finally:
+		if f_json is not None:
+			f_json.close()
+
+
+def _tap_json(items : Iterable[ClippingsItem], f : TextIO) -> Iterator[ClippingsItem]:
+	"""write each item to the json file `f` as it passes through, in the layout of `json.dump(..., indent = 4)`"""
+	for i, item in enumerate(items):
+		f.write((',' if i else '') + '\n' + textwrap.indent(
+			json.dumps(arbit_json_serialize(item), indent = 4),
+			' ' * 8,
+		))
+		yield item
@@ -0,0 +1,96 @@
+"""write-ahead journal for Zotero uploads, so an interrupted upload can be resumed
+
+each book's progress is appended as a json line, and flushed to disk before the
+step it describes is considered done. the steps for a book are:
+
+ - `begin` : about to upload, with the parent key and hash of the exported notes
+ - `uploaded` : the new attachment exists, with its key. old attachments may still exist
+ - `done` : old attachments deleted, nothing left to do for this content
+
+on restart, books whose last `done` matches the current content are skipped, and books
+which were `uploaded` but not `done` only need their old attachments deleted.
+"""
+
+from typing import *
+import json
+import os
+
+ZOTERO_UPLOAD_JOURNAL_FILE : str = '../zotero_upload_journal.jsonl'
+
+JOURNAL_STEPS : Tuple[str, ...] = ('begin', 'uploaded', 'done')
+
+
+class UploadJournal(object):
+	"""append-only journal of upload progress per book
+
+	the state of each book is the merge of its records since its last `begin`.
+	a partially written last line (from a crash mid-write) is ignored
+	"""
+
+	def __init__(self, path : str = ZOTERO_UPLOAD_JOURNAL_FILE) -> None:
+		self.path : str = path
+		self.state : Dict[str, dict] = dict()
+
+		if os.path.exists(path):
+			with open(path, 'r', encoding = 'utf-8') as f:
+				for line in f:
+					try:
+						record : dict = json.loads(line)
+					except json.decoder.JSONDecodeError:
+						continue
+					self._apply(record)
+
+		self.file : TextIO = open(path, 'a', encoding = 'utf-8')
+
+	def _apply(self, record : dict) -> None:
+		book : str = record['book']
+		if record['step'] == 'begin':
+			self.state[book] = dict()
+		self.state.setdefault(book, dict()).update(record)
+
+	def record(self, book : str, step : str, **data) -> None:
+		"""append a record, and make sure it is on disk before returning"""
+		assert step in JOURNAL_STEPS, f'unknown journal step {step}'
+		record : dict = {'book' : book, 'step' : step, **data}
+		self.file.write(json.dumps(record) + '\n')
+		self.file.flush()
+		os.fsync(self.file.fileno())
+		self._apply(record)
+
+	def is_done(self, book : str, content_hash : str, parent : str) -> bool:
+		"""whether this exact content was already fully uploaded to `parent`"""
+		state : Optional[dict] = self.state.get(book, None)
+		return (
+			(state is not None)
+			and (state['step'] == 'done')
+			and (state.get('hash') == content_hash)
+			and (state.get('parent') == parent)
+		)
+
+	def pending(self, book : str) -> Optional[dict]:
+		"""state of the book if it was begun but not finished, otherwise `None`"""
+		state : Optional[dict] = self.state.get(book, None)
+		if (state is None) or (state['step'] == 'done'):
+			return None
+		return state
+
+	def compact(self) -> None:
+		"""rewrite the journal keeping only the current state of each book, one record each. atomic"""
+		self.file.close()
+		tmp_path : str = self.path + '.tmp'
+		with open(tmp_path, 'w', encoding = 'utf-8') as f:
+			for state in self.state.values():
+				f.write(json.dumps(state) + '\n')
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp_path, self.path)
+		self.file = open(self.path, 'a', encoding = 'utf-8')
+
+	def close(self) -> None:
+		self.file.close()
+
+	def __enter__(self) -> 'UploadJournal':
+		return self
+
+	def __exit__(self, *args) -> None:
+		self.close()
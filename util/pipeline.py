@@ -0,0 +1,204 @@
+"""single-pass pipeline from a clippings file to json, markdown, and Zotero
+
+the clippings are parsed and grouped by book once, and each book is rendered once.
+the grouped data and rendered text are then shared by every sink.
+"""
+
+from typing import *
+import functools
+import json
+
+from util.json_serialize import arbit_json_serialize
+from util.clippingsitem import (
+	ClippingsItem, CLIPPINGS_FILENAME,
+	parse_clippings_file,
+)
+from util.export import (
+	sort_clippings_by_book, ClippingsItem_lst_md, ClippingsItem_to_filename,
+	DATA_EXPORT_PATH,
+)
+from util.render import CompiledTemplate, get_template
+from util.journal import UploadJournal, ZOTERO_UPLOAD_JOURNAL_FILE
+
+PipelineSink = Callable[['ClippingsPipeline'], None]
+
+
+class ClippingsPipeline(object):
+	"""parses clippings once, and fans the grouped and rendered data out to sinks
+
+	everything is computed lazily and memoized, so a sink only pays for what it uses
+
+	### Parameters:
+	 - `file_in : Union[str, Iterable[str]]`
+	   (defaults to `CLIPPINGS_FILENAME`)
+	 - `merge : bool`
+	   (defaults to `True`)
+	 - `export_func : Union[Callable[[List[ClippingsItem]], str], str, CompiledTemplate]`
+	   used to render each book, either a function or a template (by name, see `util.render.TEMPLATES`)
+	   (defaults to `ClippingsItem_lst_md`)
+	 - `data_list : Optional[List[ClippingsItem]]`
+	   clippings already parsed from `file_in` (and merged if `merge`), used instead of parsing it
+	   (defaults to `None`)
+	"""
+
+	def __init__(
+			self,
+			file_in : Union[str, Iterable[str]] = CLIPPINGS_FILENAME,
+			merge : bool = True,
+			export_func : Union[Callable[[List[ClippingsItem]], str], str, CompiledTemplate] = ClippingsItem_lst_md,
+			data_list : Optional[List[ClippingsItem]] = None,
+		) -> None:
+		if isinstance(export_func, str):
+			export_func = get_template(export_func)
+
+		self.file_in : Union[str, Iterable[str]] = file_in
+		self.merge : bool = merge
+		self.export_func : Callable[[List[ClippingsItem]], str] = export_func
+		self.extension : str = export_func.extension if isinstance(export_func, CompiledTemplate) else '.md'
+		self.sinks : List[PipelineSink] = list()
+
+		self._data_list : Optional[List[ClippingsItem]] = data_list
+		self._data_bybook : Optional[Dict[str, List[ClippingsItem]]] = None
+		self._rendered : Dict[str, str] = dict()
+
+	@property
+	def data_list(self) -> List[ClippingsItem]:
+		if self._data_list is None:
+			self._data_list = parse_clippings_file(self.file_in, merge = self.merge)
+		return self._data_list
+
+	@property
+	def data_bybook(self) -> Dict[str, List[ClippingsItem]]:
+		if self._data_bybook is None:
+			self._data_bybook = sort_clippings_by_book(self.data_list)
+		return self._data_bybook
+
+	def rendered(self, title : str) -> str:
+		"""rendered notes for the book `title`, rendering at most once"""
+		if title not in self._rendered:
+			self._rendered[title] = self.export_func(self.data_bybook[title])
+		return self._rendered[title]
+
+	def add_sink(self, sink : Optional[PipelineSink]) -> 'ClippingsPipeline':
+		"""add a sink, skipping it if `None`"""
+		if sink is not None:
+			self.sinks.append(sink)
+		return self
+
+	def run(self) -> None:
+		"""run every sink, in the order they were added"""
+		for sink in self.sinks:
+			sink(self)
+
+
+def sink_json(json_out : str = DATA_EXPORT_PATH) -> PipelineSink:
+	"""sink which saves the clippings grouped by book to `json_out`"""
+	def _sink(pipeline : ClippingsPipeline) -> None:
+		with open(json_out, 'w', newline='\n') as f:
+			json.dump(
+				arbit_json_serialize(pipeline.data_bybook),
+				f,
+				indent = 4,
+			)
+	return _sink
+
+
+def sink_markdown(out_dir : str = '../notes/') -> PipelineSink:
+	"""sink which saves the rendered notes for each book to `out_dir/<filename><extension>`"""
+	def _sink(pipeline : ClippingsPipeline) -> None:
+		for title, items in pipeline.data_bybook.items():
+			filename : str = out_dir + ClippingsItem_to_filename(items[0]) + pipeline.extension
+			with open(filename, 'w', newline='\n') as f:
+				print(f'  saving {len(items)} notes from "{title}"')
+				f.write(pipeline.rendered(title))
+	return _sink
+
+
+def sink_zotero(
+		zotero_manager : Optional['ZoteroManager'] = None,
+		target : str = 'attachment',
+		journal_path : Optional[str] = ZOTERO_UPLOAD_JOURNAL_FILE,
+		prefetch_depth : Optional[int] = None,
+		interactive : bool = True,
+	) -> PipelineSink:
+	"""sink which uploads the rendered notes for each book to Zotero, as an attachment or child note (see `zotero_upload_notes`)
+
+	progress is recorded in the upload journal at `journal_path` (skipped if `None`), see `util.journal`.
+	Zotero items for unresolved books are searched for `prefetch_depth` books ahead
+	(defaults to `ZOTERO_PREFETCH_DEPTH`), see `PossibleKeysPrefetcher`. if not `interactive`,
+	books without a known Zotero item are skipped instead of prompting
+	"""
+	def _sink(pipeline : ClippingsPipeline) -> None:
+		# imported here, since it needs the Zotero api data and dependencies
+		from util.zotero import (
+			ZoteroManager, PossibleKeysPrefetcher, zotero_upload_notes,
+			ZOTERO_PREFETCH_DEPTH,
+		)
+
+		manager : ZoteroManager = zotero_manager if zotero_manager is not None else ZoteroManager()
+		journal : Optional[UploadJournal] = UploadJournal(journal_path) if journal_path is not None else None
+		depth : int = prefetch_depth if prefetch_depth is not None else ZOTERO_PREFETCH_DEPTH
+		# nothing to prefetch if the user is never prompted
+		prefetcher : PossibleKeysPrefetcher = PossibleKeysPrefetcher.for_books(
+			manager, pipeline.data_bybook.values(),
+			depth if interactive else 0,
+		)
+		try:
+			for title, items in pipeline.data_bybook.items():
+				print(f'# uploading "{title}"')
+				zotero_upload_notes(
+					manager, items,
+					export_func = pipeline.export_func,
+					# rendered only if the book is uploaded, and not re-rendered as html for notes
+					notes_export = functools.partial(pipeline.rendered, title),
+					target = target,
+					journal = journal,
+					prefetcher = prefetcher,
+					interactive = interactive,
+				)
+			if journal is not None:
+				journal.compact()
+		finally:
+			prefetcher.close()
+			if journal is not None:
+				journal.close()
+	return _sink
+
+
+def sync(
+		file_in : Union[str, Iterable[str]] = CLIPPINGS_FILENAME,
+		out_dir : Optional[str] = '../notes/',
+		json_out : Optional[str] = DATA_EXPORT_PATH,
+		zotero : bool = True,
+		fmt : str = 'md',
+		zotero_target : str = 'attachment',
+	) -> None:
+	"""parse `file_in` once, and export it to json, markdown, and Zotero in one pass
+
+	### Parameters:
+	 - `file_in : Union[str, Iterable[str]]`
+	   (defaults to `CLIPPINGS_FILENAME`)
+	 - `out_dir : Optional[str]`
+	   directory for markdown files, skipped if `None`
+	   (defaults to `'../notes/'`)
+	 - `json_out : Optional[str]`
+	   path for the json export, skipped if `None`
+	   (defaults to `DATA_EXPORT_PATH`)
+	 - `zotero : bool`
+	   whether to upload to Zotero
+	   (defaults to `True`)
+	 - `fmt : str`
+	   template used to render each book, see `util.render.TEMPLATES`
+	   (defaults to `'md'`)
+	 - `zotero_target : str`
+	   `'attachment'` or `'note'`, see `zotero_upload_notes`
+	   (defaults to `'attachment'`)
+	"""
+
+	(
+		ClippingsPipeline(file_in, export_func = fmt)
+		.add_sink(sink_json(json_out) if json_out is not None else None)
+		.add_sink(sink_markdown(out_dir) if out_dir is not None else None)
+		.add_sink(sink_zotero(target = zotero_target) if zotero else None)
+		.run()
+	)
@@ -0,0 +1,251 @@
+"""template-based, streaming rendering of clippings
+
+a `ClippingsTemplate` is compiled once into a `CompiledTemplate`, which writes
+each item straight to a file handle instead of building the document in memory.
+built-in templates are in `TEMPLATES`: markdown, html, csv, and org-mode.
+"""
+
+from typing import *
+import csv
+import html
+import io
+import string
+
+from util.clippingsitem import (
+	ClippingsType, ClippingsItem,
+)
+
+ClippingsTemplate = NamedTuple('ClippingsTemplate', [
+	# file extension, including the dot
+	('extension', str),
+	# format strings. `header` and `footer` can use the fields of the first item
+	('header', str),
+	('item', Dict[ClippingsType, str]),
+	('separator', str),
+	('footer', str),
+	# derived fields, available to the format strings by name. these handle their own escaping
+	('fields', Dict[str, Callable[[ClippingsItem], str]]),
+	# escaping applied to the raw `ClippingsItem` fields
+	('escape', Callable[[str], str]),
+])
+
+# one piece of a compiled format string: literal text followed by an optional field getter
+_TemplatePart = Tuple[str, Optional[Callable[[ClippingsItem], str]]]
+
+
+def _text(x : Optional[str]) -> str:
+	return '' if x is None else x.strip()
+
+
+class CompiledTemplate(object):
+	"""a `ClippingsTemplate` with its format strings parsed once into literal/getter pairs
+
+	also usable as an `export_func`, since calling it renders a list of items to a string
+	"""
+
+	def __init__(self, template : ClippingsTemplate) -> None:
+		self.template : ClippingsTemplate = template
+		self.extension : str = template.extension
+		self.header : List[_TemplatePart] = self._compile(template.header)
+		self.item : Dict[str, List[_TemplatePart]] = {
+			clip_type : self._compile(fmt)
+			for clip_type, fmt in template.item.items()
+		}
+		self.footer : List[_TemplatePart] = self._compile(template.footer)
+
+	def _getter(self, name : str, spec : str) -> Callable[[ClippingsItem], str]:
+		"""getter for the field `name`, with format spec `spec`"""
+		if name in self.template.fields:
+			func : Callable[[ClippingsItem], str] = self.template.fields[name]
+		elif name in ClippingsItem._fields:
+			escape : Callable[[str], str] = self.template.escape
+			idx : int = ClippingsItem._fields.index(name)
+			func = lambda item : '' if item[idx] is None else escape(str(item[idx]))
+		else:
+			raise KeyError(f'unknown template field "{name}", expected one of {list(self.template.fields) + list(ClippingsItem._fields)}')
+
+		if spec:
+			return lambda item : format(func(item), spec)
+		return func
+
+	def _compile(self, fmt : str) -> List[_TemplatePart]:
+		return [
+			(literal, None if name is None else self._getter(name, spec))
+			for literal, name, spec, _ in string.Formatter().parse(fmt)
+		]
+
+	@staticmethod
+	def _write(f : TextIO, parts : List[_TemplatePart], item : ClippingsItem) -> None:
+		for literal, getter in parts:
+			f.write(literal)
+			if getter is not None:
+				f.write(getter(item))
+
+	def render_to(
+			self,
+			data : Iterable[ClippingsItem],
+			f : TextIO,
+			sort_clipitems : Optional[Callable] = lambda x : x.date_unix,
+		) -> int:
+		"""write the items in `data` to `f`, one at a time
+
+		if `sort_clipitems` is `None`, `data` is assumed to already be sorted, and is
+		consumed lazily -- so it can be a generator. all items should be from one book
+
+		### Returns:
+		 - `int`
+		   number of items written
+		"""
+		if sort_clipitems is not None:
+			data = sorted(data, key = sort_clipitems)
+
+		n_items : int = 0
+		first : Optional[ClippingsItem] = None
+		for item in data:
+			if first is None:
+				first = item
+				self._write(f, self.header, first)
+			else:
+				assert (item.title, item.author) == (first.title, first.author), 'all items must have the same title and author'
+				f.write(self.template.separator)
+			self._write(f, self.item[item.clip_type], item)
+			n_items += 1
+
+		if first is not None:
+			self._write(f, self.footer, first)
+
+		return n_items
+
+	def render(self, data : Iterable[ClippingsItem], sort_clipitems : Optional[Callable] = lambda x : x.date_unix) -> str:
+		"""render to a string"""
+		f : io.StringIO = io.StringIO()
+		self.render_to(data, f, sort_clipitems = sort_clipitems)
+		return f.getvalue()
+
+	def __call__(self, data : List[ClippingsItem]) -> str:
+		return self.render(data)
+
+
+# markdown
+# ==================================================
+
+_MD_ITEM_HEAD : Callable[[str], str] = lambda clip_type_text : f'- {clip_type_text} at location **{{location}}** made on *{{date}}*   \n'
+_MD_NOTE : str = '  ```\n   {md_note}\n  ```   '
+
+TEMPLATE_MARKDOWN : ClippingsTemplate = ClippingsTemplate(
+	extension = '.md',
+	header = '# {title}\n\n\n**by {author}**\n\n\n',
+	item = {
+		'Highlight' : _MD_ITEM_HEAD('Highlight') + '   > {md_highlight}   ',
+		'Note' : _MD_ITEM_HEAD('Note') + '   (unknown highlighted text)   \n' + _MD_NOTE,
+		'Note_Merged' : _MD_ITEM_HEAD('Note') + '   > {md_highlight}   \n' + _MD_NOTE,
+	},
+	separator = '\n\n',
+	footer = '',
+	fields = {
+		'md_highlight' : lambda item : _text(item.text_highlight).replace("\n", "\n   > "),
+		'md_note' : lambda item : _text(item.text_note).replace("\n", "  \n   "),
+	},
+	escape = lambda x : x,
+)
+
+# html
+# ==================================================
+
+_HTML_ITEM_HEAD : Callable[[str], str] = lambda clip_type_text : f'<li><p>{clip_type_text} at location <strong>{{location}}</strong> made on <em>{{date}}</em></p>'
+_html_block : Callable[[Optional[str]], str] = lambda x : html.escape(_text(x)).replace("\n", "<br/>\n")
+
+TEMPLATE_HTML : ClippingsTemplate = ClippingsTemplate(
+	extension = '.html',
+	header = '<h1>{title}</h1>\n<p><strong>by {author}</strong></p>\n<ul>\n',
+	item = {
+		'Highlight' : _HTML_ITEM_HEAD('Highlight') + '<blockquote>{html_highlight}</blockquote></li>',
+		'Note' : _HTML_ITEM_HEAD('Note') + '<p>{html_note}</p></li>',
+		'Note_Merged' : _HTML_ITEM_HEAD('Note') + '<blockquote>{html_highlight}</blockquote><p>{html_note}</p></li>',
+	},
+	separator = '\n',
+	footer = '\n</ul>\n',
+	fields = {
+		'html_highlight' : lambda item : _html_block(item.text_highlight),
+		'html_note' : lambda item : _html_block(item.text_note),
+	},
+	escape = html.escape,
+)
+
+# csv
+# ==================================================
+
+def _csv_escape(x : str) -> str:
+	"""quote a single csv value"""
+	f : io.StringIO = io.StringIO()
+	csv.writer(f, lineterminator = '').writerow([x])
+	return f.getvalue()
+
+_CSV_ROW : str = ','.join('{' + k + '}' for k in ClippingsItem._fields)
+
+TEMPLATE_CSV : ClippingsTemplate = ClippingsTemplate(
+	extension = '.csv',
+	header = ','.join(ClippingsItem._fields) + '\n',
+	item = {
+		'Highlight' : _CSV_ROW,
+		'Note' : _CSV_ROW,
+		'Note_Merged' : _CSV_ROW,
+	},
+	separator = '\n',
+	footer = '\n',
+	fields = dict(),
+	escape = _csv_escape,
+)
+
+# org-mode
+# ==================================================
+
+def _org_block(x : Optional[str]) -> str:
+	"""escape lines which org would read as headings or block delimiters"""
+	return '\n'.join(
+		',' + line if line.startswith(('*', '#+')) else line
+		for line in _text(x).split('\n')
+	)
+
+_ORG_ITEM_HEAD : Callable[[str], str] = lambda clip_type_text : f'** {clip_type_text} at location {{location}}\n[{{date}}]\n'
+_ORG_QUOTE : str = '#+begin_quote\n{org_highlight}\n#+end_quote'
+
+TEMPLATE_ORG : ClippingsTemplate = ClippingsTemplate(
+	extension = '.org',
+	header = '* {title}\n:PROPERTIES:\n:AUTHOR: {author}\n:END:\n\n',
+	item = {
+		'Highlight' : _ORG_ITEM_HEAD('Highlight') + _ORG_QUOTE,
+		'Note' : _ORG_ITEM_HEAD('Note') + '{org_note}',
+		'Note_Merged' : _ORG_ITEM_HEAD('Note') + _ORG_QUOTE + '\n{org_note}',
+	},
+	separator = '\n\n',
+	footer = '\n',
+	fields = {
+		'org_highlight' : lambda item : _org_block(item.text_highlight),
+		'org_note' : lambda item : _org_block(item.text_note),
+	},
+	escape = lambda x : x.replace('\n', ' '),
+)
+
+
+TEMPLATES : Dict[str, ClippingsTemplate] = {
+	'md' : TEMPLATE_MARKDOWN,
+	'html' : TEMPLATE_HTML,
+	'csv' : TEMPLATE_CSV,
+	'org' : TEMPLATE_ORG,
+}
+
+_COMPILED_TEMPLATES : Dict[str, CompiledTemplate] = dict()
+
+
+def get_template(fmt : Union[str, ClippingsTemplate, CompiledTemplate] = 'md') -> CompiledTemplate:
+	"""get a compiled template by name (compiling built-in templates only once), or compile a custom template"""
+	if isinstance(fmt, CompiledTemplate):
+		return fmt
+	if isinstance(fmt, str):
+		if fmt not in TEMPLATES:
+			raise KeyError(f'unknown template "{fmt}", expected one of {list(TEMPLATES)}')
+		if fmt not in _COMPILED_TEMPLATES:
+			_COMPILED_TEMPLATES[fmt] = CompiledTemplate(TEMPLATES[fmt])
+		return _COMPILED_TEMPLATES[fmt]
+	return CompiledTemplate(fmt)
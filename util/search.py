@@ -0,0 +1,309 @@
+"""persistent inverted index over clippings, with BM25 ranking
+
+the index is stored in an sqlite database, with one row per (term, clipping) posting.
+querying only touches the postings of the query terms, so nothing needs to be re-parsed
+or re-loaded to search.
+"""
+
+from typing import *
+import datetime
+import math
+import re
+import sqlite3
+
+from util.clippingsitem import (
+	ClippingsItem, CLIPPINGS_FILENAME,
+	parse_clippings_file, clippings_fingerprint,
+)
+
+SEARCH_INDEX_PATH : str = '../search_index.sqlite'
+
+# BM25 parameters
+BM25_K1 : float = 1.2
+BM25_B : float = 0.75
+
+TOKEN_REGEX : Pattern = re.compile(r'\w+', re.UNICODE)
+
+SEARCH_INDEX_SCHEMA : str = """
+CREATE TABLE IF NOT EXISTS docs (
+	doc_id INTEGER PRIMARY KEY,
+	fingerprint TEXT UNIQUE NOT NULL,
+	title TEXT NOT NULL,
+	author TEXT NOT NULL,
+	location TEXT NOT NULL,
+	clip_type TEXT NOT NULL,
+	date TEXT NOT NULL,
+	date_unix INTEGER NOT NULL,
+	text_highlight TEXT,
+	text_note TEXT,
+	length INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+	term TEXT NOT NULL,
+	doc_id INTEGER NOT NULL,
+	tf INTEGER NOT NULL,
+	PRIMARY KEY (term, doc_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS terms (
+	term TEXT PRIMARY KEY,
+	df INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+	key TEXT PRIMARY KEY,
+	value INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS docs_date_unix ON docs (date_unix);
+"""
+
+
+def tokenize(text : Optional[str]) -> List[str]:
+	"""lowercase word tokens of `text`"""
+	if not text:
+		return []
+	return TOKEN_REGEX.findall(text.lower())
+
+
+def like_escape(text : str) -> str:
+	"""escape `\\`, `%` and `_` in `text`, for a `LIKE` pattern with `ESCAPE '\\'`"""
+	return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def parse_date_arg(date : Union[None, int, float, str]) -> Optional[int]:
+	"""convert a unix timestamp or `YYYY-MM-DD` string to a unix timestamp"""
+	if date is None:
+		return None
+	if isinstance(date, (int, float)):
+		return int(date)
+	return int(datetime.datetime.strptime(str(date).strip(), '%Y-%m-%d').timestamp())
+
+
+SearchResult = NamedTuple('SearchResult', [
+	('score', float),
+	('item', ClippingsItem),
+])
+
+
+class SearchIndex(object):
+	"""inverted index over `text_highlight` and `text_note` of clippings
+
+	documents are keyed by `clippings_fingerprint`, so adding the same clippings
+	again is a no-op, and only new clippings are indexed. only raw (un-merged) clippings
+	are indexed: merging a note into an already indexed highlight would change its
+	fingerprint, and leave both the old and merged documents in the index
+	"""
+
+	def __init__(self, path : str = SEARCH_INDEX_PATH, check_same_thread : bool = True) -> None:
+		self.path : str = path
+		self.conn : sqlite3.Connection = sqlite3.connect(path, check_same_thread = check_same_thread)
+		self.conn.executescript(SEARCH_INDEX_SCHEMA)
+
+	def close(self) -> None:
+		self.conn.close()
+
+	def __enter__(self) -> 'SearchIndex':
+		return self
+
+	def __exit__(self, *args) -> None:
+		self.close()
+
+	def _get_meta(self, key : str) -> int:
+		row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+		return 0 if row is None else row[0]
+
+	def n_docs(self) -> int:
+		return self._get_meta('n_docs')
+
+	def add(self, items : Iterable[ClippingsItem]) -> int:
+		"""add raw clippings (parsed with `merge=False`) to the index, skipping those already indexed
+
+		### Returns:
+		 - `int`
+		   number of newly indexed clippings
+		"""
+		n_new : int = 0
+		total_length : int = 0
+		df_delta : Dict[str, int] = dict()
+
+		with self.conn:
+			for item in items:
+				if item.clip_type == 'Note_Merged':
+					raise ValueError(f'only raw clippings can be indexed, parse with `merge=False`. got {item}')
+				tokens : List[str] = tokenize(item.text_highlight) + tokenize(item.text_note)
+				cur = self.conn.execute(
+					'INSERT OR IGNORE INTO docs '
+					'(fingerprint, title, author, location, clip_type, date, date_unix, text_highlight, text_note, length) '
+					'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+					(
+						clippings_fingerprint(item),
+						item.title, item.author, item.location, item.clip_type,
+						item.date, item.date_unix, item.text_highlight, item.text_note,
+						len(tokens),
+					),
+				)
+				if cur.rowcount == 0:
+					# already indexed
+					continue
+
+				doc_id : int = cur.lastrowid
+				term_freqs : Dict[str, int] = dict()
+				for tok in tokens:
+					term_freqs[tok] = term_freqs.get(tok, 0) + 1
+
+				self.conn.executemany(
+					'INSERT INTO postings (term, doc_id, tf) VALUES (?, ?, ?)',
+					[ (term, doc_id, tf) for term, tf in term_freqs.items() ],
+				)
+				for term in term_freqs:
+					df_delta[term] = df_delta.get(term, 0) + 1
+
+				n_new += 1
+				total_length += len(tokens)
+
+			self.conn.executemany(
+				'INSERT INTO terms (term, df) VALUES (?, ?) '
+				'ON CONFLICT (term) DO UPDATE SET df = df + excluded.df',
+				list(df_delta.items()),
+			)
+			self.conn.executemany(
+				'INSERT INTO meta (key, value) VALUES (?, ?) '
+				'ON CONFLICT (key) DO UPDATE SET value = value + excluded.value',
+				[ ('n_docs', n_new), ('total_length', total_length) ],
+			)
+
+		return n_new
+
+	def search(
+			self,
+			query : str,
+			book : Optional[str] = None,
+			author : Optional[str] = None,
+			date_from : Union[None, int, str] = None,
+			date_to : Union[None, int, str] = None,
+			limit : int = 10,
+		) -> List[SearchResult]:
+		"""search the index, ranking with BM25
+
+		### Parameters:
+		 - `query : str`
+		 - `book : Optional[str]`
+		   only clippings whose title contains this (case insensitive)
+		 - `author : Optional[str]`
+		   only clippings whose author contains this (case insensitive)
+		 - `date_from : Union[None, int, str]`
+		   unix timestamp or `YYYY-MM-DD`, inclusive
+		 - `date_to : Union[None, int, str]`
+		   unix timestamp or `YYYY-MM-DD`, exclusive
+		 - `limit : int`
+		   (defaults to `10`)
+
+		### Returns:
+		 - `List[SearchResult]`
+		"""
+		terms : List[str] = sorted(set(tokenize(query)))
+		n_docs : int = self.n_docs()
+		if (not terms) or (n_docs == 0):
+			return []
+		avg_length : float = self._get_meta('total_length') / n_docs
+
+		# idf per term, skipping terms which are not in the index at all
+		idf : Dict[str, float] = {
+			term : math.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+			for term, df in self.conn.execute(
+				f'SELECT term, df FROM terms WHERE term IN ({",".join("?" * len(terms))})',
+				terms,
+			)
+		}
+		if not idf:
+			return []
+
+		# filters on the documents
+		conditions : List[str] = list()
+		params : List[Any] = list()
+		if book is not None:
+			conditions.append("docs.title LIKE ? ESCAPE '\\'")
+			params.append(f'%{like_escape(book)}%')
+		if author is not None:
+			conditions.append("docs.author LIKE ? ESCAPE '\\'")
+			params.append(f'%{like_escape(author)}%')
+		if date_from is not None:
+			conditions.append("docs.date_unix >= ?")
+			params.append(parse_date_arg(date_from))
+		if date_to is not None:
+			conditions.append("docs.date_unix < ?")
+			params.append(parse_date_arg(date_to))
+
+		query_terms : List[str] = list(idf.keys())
+		rows = self.conn.execute(
+			'SELECT postings.doc_id, postings.term, postings.tf, docs.length '
+			'FROM postings JOIN docs ON docs.doc_id = postings.doc_id '
+			f'WHERE postings.term IN ({",".join("?" * len(query_terms))})'
+			+ ''.join(f' AND {c}' for c in conditions),
+			query_terms + params,
+		)
+
+		scores : Dict[int, float] = dict()
+		for doc_id, term, tf, length in rows:
+			norm : float = BM25_K1 * (1.0 - BM25_B + BM25_B * length / avg_length)
+			scores[doc_id] = scores.get(doc_id, 0.0) + idf[term] * tf * (BM25_K1 + 1.0) / (tf + norm)
+
+		top : List[Tuple[int, float]] = sorted(scores.items(), key = lambda x : -x[1])[:limit]
+		if not top:
+			return []
+
+		docs : Dict[int, ClippingsItem] = {
+			row[0] : ClippingsItem(*row[1:])
+			for row in self.conn.execute(
+				'SELECT doc_id, title, author, location, clip_type, date, date_unix, text_highlight, text_note '
+				f'FROM docs WHERE doc_id IN ({",".join("?" * len(top))})',
+				[ doc_id for doc_id, _ in top ],
+			)
+		}
+
+		return [
+			SearchResult(score = score, item = docs[doc_id])
+			for doc_id, score in top
+		]
+
+
+def search_index_update(
+		file_in : Union[str, Iterable[str]] = CLIPPINGS_FILENAME,
+		index_path : str = SEARCH_INDEX_PATH,
+	) -> None:
+	"""parse `file_in` and add any new clippings to the search index"""
+	with SearchIndex(index_path) as index:
+		n_new : int = index.add(parse_clippings_file(file_in, merge = False))
+		print(f'  indexed {n_new} new clippings, {index.n_docs()} total')
+
+
+def search_clippings(
+		query : str,
+		book : Optional[str] = None,
+		author : Optional[str] = None,
+		date_from : Union[None, int, str] = None,
+		date_to : Union[None, int, str] = None,
+		limit : int = 10,
+		index_path : str = SEARCH_INDEX_PATH,
+		update_from : Union[None, str, Iterable[str]] = None,
+	) -> None:
+	"""search the clippings index and print the results
+
+	if `update_from` is given, clippings from that file are indexed first
+	"""
+	if update_from is not None:
+		search_index_update(update_from, index_path)
+
+	with SearchIndex(index_path) as index:
+		results : List[SearchResult] = index.search(
+			query,
+			book = book, author = author,
+			date_from = date_from, date_to = date_to,
+			limit = limit,
+		)
+
+	for res in results:
+		item : ClippingsItem = res.item
+		print(f'[{res.score:.2f}] "{item.title}" by "{item.author}", location {item.location}, {item.date}')
+		if item.text_highlight:
+			print(f'    > {item.text_highlight}')
+		if item.text_note:
+			print(f'    note: {item.text_note}')
@@ -0,0 +1,345 @@
+"""long-running local server, keeping parsed clippings in memory between requests
+
+`serve` parses the clippings once, and answers requests from memory: the grouped
+clippings, the rendered notes (each rendered at most once), the search index connection,
+and the Zotero cache. the clippings file is checked on every request (a `stat`), and
+re-parsed only if it changed, keeping the rendered notes of books whose clippings did
+not change.
+
+endpoints, all returning json unless noted:
+ - `GET /books`: title, author, number of clippings, and Zotero key of every book
+ - `GET /books/<title>`: the clippings of a book
+ - `GET /books/<title>/notes?fmt=md`: the rendered notes of a book, as text
+ - `GET /search?q=...&book=&author=&date_from=&date_to=&limit=`: see `SearchIndex.search`
+ - `GET /status`: the files being served and when they were last parsed
+ - `POST /sync?zotero=0&zotero_target=attachment`: export to json and markdown
+   (and Zotero, non-interactively) from the in-memory data, like `sync`
+"""
+
+from typing import *
+import http.server
+import json
+import os
+import threading
+import time
+import traceback
+import urllib.parse
+
+from util.json_serialize import arbit_json_serialize
+from util.clippingsitem import (
+	ClippingsItem, CLIPPINGS_FILENAME,
+	expand_clippings_filenames, parse_clippings_file, merge_list_clip_items,
+)
+from util.export import DATA_EXPORT_PATH
+from util.pipeline import ClippingsPipeline, sink_json, sink_markdown, sink_zotero
+from util.render import CompiledTemplate, get_template
+from util.search import SearchIndex, SearchResult, SEARCH_INDEX_PATH
+
+SERVE_HOST : str = '127.0.0.1'
+SERVE_PORT : int = 8737
+
+NOTES_CONTENT_TYPES : Dict[str, str] = {
+	'.md' : 'text/markdown',
+	'.html' : 'text/html',
+	'.csv' : 'text/csv',
+	'.org' : 'text/plain',
+}
+
+# `(size, mtime_ns)` of each input file, to detect changes
+FileStats = Tuple[Tuple[str, int, int], ...]
+
+
+class ClippingsState(object):
+	"""the in-memory state of the server: parsed clippings, rendered notes, search index, and Zotero cache
+
+	safe to use from the server's request threads. a refresh swaps in a new pipeline,
+	so requests already running keep using the data they started with
+	"""
+
+	def __init__(
+			self,
+			file_in : Union[str, Iterable[str]] = CLIPPINGS_FILENAME,
+			fmt : str = 'md',
+			index_path : str = SEARCH_INDEX_PATH,
+		) -> None:
+		self.file_in : Union[str, Iterable[str]] = file_in
+		self.fmt : str = fmt
+		self.pipeline : Optional[ClippingsPipeline] = None
+		self.file_stats : Optional[FileStats] = None
+		self.last_refresh : Optional[float] = None
+
+		# rendered notes in formats other than `fmt`, keyed by `(fmt, title)`
+		self._rendered : Dict[Tuple[str, str], str] = dict()
+		self._lock : threading.RLock = threading.RLock()
+		self._sync_lock : threading.Lock = threading.Lock()
+
+		self.search_index : SearchIndex = SearchIndex(index_path, check_same_thread = False)
+
+		# zotero cache, reloaded when the file changes
+		self._zk_cache : Dict[str, Any] = dict()
+		self._zk_cache_mtime : Optional[int] = None
+
+		self.refresh()
+
+	def _stat(self) -> FileStats:
+		stats : List[Tuple[str, int, int]] = list()
+		for fname in expand_clippings_filenames(self.file_in):
+			st : os.stat_result = os.stat(fname)
+			stats.append((fname, st.st_size, st.st_mtime_ns))
+		return tuple(stats)
+
+	def refresh(self) -> bool:
+		"""re-parse the input files if they changed since the last parse, returning whether they did"""
+		file_stats : FileStats = self._stat()
+		if file_stats == self.file_stats:
+			return False
+
+		with self._lock:
+			# another thread might have refreshed while we waited
+			if file_stats == self.file_stats:
+				return False
+
+			# parsed once: the index holds raw clippings (see `SearchIndex`), the pipeline merged ones
+			data_raw : List[ClippingsItem] = parse_clippings_file(self.file_in, merge = False)
+			pipeline : ClippingsPipeline = ClippingsPipeline(
+				self.file_in,
+				export_func = self.fmt,
+				data_list = merge_list_clip_items(data_raw),
+			)
+			bybook_new : Dict[str, List[ClippingsItem]] = pipeline.data_bybook
+
+			# keep rendered notes for books whose clippings did not change
+			if self.pipeline is not None:
+				bybook_old : Dict[str, List[ClippingsItem]] = self.pipeline.data_bybook
+				unchanged : Set[str] = {
+					title
+					for title, items in bybook_new.items()
+					if bybook_old.get(title, None) == items
+				}
+				# `sync` may be rendering into the old pipeline without the lock, so iterate over a copy
+				pipeline._rendered = {
+					k : v for k, v in self.pipeline._rendered.copy().items()
+					if k in unchanged
+				}
+				self._rendered = {
+					k : v for k, v in self._rendered.items()
+					if k[1] in unchanged
+				}
+
+			n_new : int = self.search_index.add(data_raw)
+
+			self.pipeline = pipeline
+			self.file_stats = file_stats
+			self.last_refresh = time.time()
+			print(f'  parsed {len(pipeline.data_list)} clippings from {len(bybook_new)} books, indexed {n_new} new')
+			return True
+
+	def zk_cache(self) -> Dict[str, Any]:
+		"""the Zotero cache, reloaded only when its file changes"""
+		# imported here, since it needs the Zotero api dependencies
+		from util.zotero import ZOTERO_KINDLE_CACHE_FILE, zk_cache_load
+
+		if not os.path.exists(ZOTERO_KINDLE_CACHE_FILE):
+			return dict()
+		mtime : int = os.stat(ZOTERO_KINDLE_CACHE_FILE).st_mtime_ns
+		with self._lock:
+			if mtime != self._zk_cache_mtime:
+				self._zk_cache = zk_cache_load()
+				self._zk_cache_mtime = mtime
+			return self._zk_cache
+
+	def books(self) -> List[dict]:
+		from util.zotero import ZKCacheKey, ZKCacheKey_tostr
+
+		cache : Dict[str, Any] = self.zk_cache()
+		output : List[dict] = list()
+		for title, items in self.pipeline.data_bybook.items():
+			zotero_key = cache.get(ZKCacheKey_tostr(ZKCacheKey(title, items[0].author)), None)
+			output.append({
+				'title' : title,
+				'author' : items[0].author,
+				'n_items' : len(items),
+				'zotero_key' : zotero_key if isinstance(zotero_key, str) else None,
+			})
+		return output
+
+	def book(self, title : str) -> List[ClippingsItem]:
+		"""clippings of the book `title`, raising `KeyError` if there is no such book"""
+		return self.pipeline.data_bybook[title]
+
+	def notes(self, title : str, fmt : Optional[str] = None) -> Tuple[str, str]:
+		"""`(extension, text)` of the rendered notes for `title`, rendering at most once per format"""
+		# the caches are pruned by `refresh`, and read by other requests
+		with self._lock:
+			pipeline : ClippingsPipeline = self.pipeline
+			if (fmt is None) or (fmt == self.fmt):
+				return pipeline.extension, pipeline.rendered(title)
+
+			template : CompiledTemplate = get_template(fmt)
+			key : Tuple[str, str] = (fmt, title)
+			if key not in self._rendered:
+				self._rendered[key] = template.render(pipeline.data_bybook[title])
+			return template.extension, self._rendered[key]
+
+	def search(self, query : str, **kwargs) -> List[SearchResult]:
+		# sqlite connections can be shared between threads, but not used concurrently
+		with self._lock:
+			return self.search_index.search(query, **kwargs)
+
+	def sync(
+			self,
+			out_dir : Optional[str] = '../notes/',
+			json_out : Optional[str] = DATA_EXPORT_PATH,
+			zotero : bool = False,
+			zotero_target : str = 'attachment',
+		) -> None:
+		"""run the sinks of `sync` on the in-memory data. Zotero uploads never prompt, see `sink_zotero`"""
+		with self._sync_lock:
+			pipeline : ClippingsPipeline = self.pipeline
+			pipeline.sinks = list()
+			(
+				pipeline
+				.add_sink(sink_json(json_out) if json_out is not None else None)
+				.add_sink(sink_markdown(out_dir) if out_dir is not None else None)
+				.add_sink(sink_zotero(target = zotero_target, interactive = False) if zotero else None)
+				.run()
+			)
+
+	def close(self) -> None:
+		self.search_index.close()
+
+
+class ClippingsRequestHandler(http.server.BaseHTTPRequestHandler):
+	"""json api over a `ClippingsState`, see the module docstring"""
+
+	# keep connections alive between requests
+	protocol_version : str = 'HTTP/1.1'
+	# headers and body are written separately, which nagle's algorithm would delay by ~40ms
+	disable_nagle_algorithm : bool = True
+	server : 'ClippingsServer'
+
+	def log_message(self, format : str, *args) -> None:
+		# only log errors, not every request
+		pass
+
+	def _send(self, status : int, body : Union[str, bytes], content_type : str = 'application/json') -> None:
+		if isinstance(body, str):
+			body = body.encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def _send_json(self, obj : Any, status : int = 200) -> None:
+		self._send(status, json.dumps(arbit_json_serialize(obj), ensure_ascii = False))
+
+	def _send_error(self, status : int, message : str) -> None:
+		self._send_json({'error' : message}, status)
+
+	def _route(self, method : str) -> None:
+		url : urllib.parse.ParseResult = urllib.parse.urlparse(self.path)
+		params : Dict[str, str] = dict(urllib.parse.parse_qsl(url.query))
+		parts : List[str] = [ urllib.parse.unquote(x) for x in url.path.strip('/').split('/') if x ]
+		state : ClippingsState = self.server.state
+
+		try:
+			state.refresh()
+		except OSError as e:
+			# e.g. the kindle was unplugged
+			self._send_error(503, f'could not read clippings: {e}')
+			return
+
+		try:
+			if (method == 'GET') and (parts == ['books']):
+				self._send_json(state.books())
+			elif (method == 'GET') and (len(parts) == 2) and (parts[0] == 'books'):
+				self._send_json(state.book(parts[1]))
+			elif (method == 'GET') and (len(parts) == 3) and (parts[0] == 'books') and (parts[2] == 'notes'):
+				extension, text = state.notes(parts[1], params.get('fmt', None))
+				self._send(200, text, NOTES_CONTENT_TYPES.get(extension, 'text/plain'))
+			elif (method == 'GET') and (parts == ['search']):
+				if 'q' not in params:
+					self._send_error(400, 'missing query parameter `q`')
+					return
+				results : List[SearchResult] = state.search(
+					params['q'],
+					book = params.get('book', None),
+					author = params.get('author', None),
+					date_from = params.get('date_from', None),
+					date_to = params.get('date_to', None),
+					limit = int(params.get('limit', 10)),
+				)
+				self._send_json(results)
+			elif (method == 'GET') and (parts == ['status']):
+				self._send_json({
+					'files' : [ {'path' : x[0], 'size' : x[1], 'mtime_ns' : x[2]} for x in state.file_stats ],
+					'last_refresh' : state.last_refresh,
+					'n_items' : len(state.pipeline.data_list),
+					'n_books' : len(state.pipeline.data_bybook),
+				})
+			elif (method == 'POST') and (parts == ['sync']):
+				state.sync(zotero = params.get('zotero', '0') not in ('0', 'false', 'False', ''), zotero_target = params.get('zotero_target', 'attachment'))
+				self._send_json({'status' : 'success'})
+			else:
+				self._send_error(404, f'unknown endpoint {method} {url.path}')
+		except KeyError as e:
+			self._send_error(404, f'not found: {e.args[0] if e.args else e}')
+		except ValueError as e:
+			self._send_error(400, str(e))
+		except Exception as e:
+			# e.g. Zotero api errors from `/sync`. reply, rather than dropping the connection
+			traceback.print_exc()
+			self._send_error(500, f'{type(e).__name__}: {e}')
+
+	def do_GET(self) -> None:
+		self._route('GET')
+
+	def do_POST(self) -> None:
+		# the body is not used, but must be read to keep the connection usable
+		self.rfile.read(int(self.headers.get('Content-Length', 0)))
+		self._route('POST')
+
+
+class ClippingsServer(http.server.ThreadingHTTPServer):
+	daemon_threads : bool = True
+
+	def __init__(self, address : Tuple[str, int], state : ClippingsState) -> None:
+		super().__init__(address, ClippingsRequestHandler)
+		self.state : ClippingsState = state
+
+
+def serve(
+		file_in : Union[str, Iterable[str]] = CLIPPINGS_FILENAME,
+		host : str = SERVE_HOST,
+		port : int = SERVE_PORT,
+		fmt : str = 'md',
+		index_path : str = SEARCH_INDEX_PATH,
+	) -> None:
+	"""serve the clippings in `file_in` over a local json api until interrupted, see `util.server`
+
+	### Parameters:
+	 - `file_in : Union[str, Iterable[str]]`
+	   (defaults to `CLIPPINGS_FILENAME`)
+	 - `host : str`
+	   only listens locally by default
+	   (defaults to `SERVE_HOST`)
+	 - `port : int`
+	   (defaults to `SERVE_PORT`)
+	 - `fmt : str`
+	   default template for rendered notes, see `util.render.TEMPLATES`
+	   (defaults to `'md'`)
+	 - `index_path : str`
+	   search index, updated with new clippings on every refresh
+	   (defaults to `SEARCH_INDEX_PATH`)
+	"""
+	state : ClippingsState = ClippingsState(file_in, fmt = fmt, index_path = index_path)
+	server : ClippingsServer = ClippingsServer((host, port), state)
+	print(f'# serving clippings from {file_in} on http://{host}:{port}/')
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		state.close()
@@ -0,0 +1,247 @@
+"""columnar, numpy-backed table of clippings for vectorized queries and reading analytics
+
+numeric columns (`date_unix`, location start/end, clip type) are numpy arrays.
+title and author are stored as categorical integer codes, and the text columns
+are kept in side arrays of python objects, only touched when items are rebuilt.
+"""
+
+from typing import *
+
+import numpy as np
+
+from util.clippingsitem import (
+	ClippingsType, ClippingsItem,
+	parse_location_range,
+)
+
+CLIP_TYPES : List[ClippingsType] = ["Highlight", "Note", "Note_Merged"]
+
+# default gap between clippings, in seconds, which starts a new reading session
+READING_SESSION_GAP : int = 30 * 60
+
+
+def _encode_categorical(values : List[str]) -> Tuple[np.ndarray, List[str]]:
+	"""encode strings as integer codes, with categories in order of first appearance"""
+	categories : Dict[str, int] = dict()
+	codes : np.ndarray = np.fromiter(
+		(categories.setdefault(v, len(categories)) for v in values),
+		dtype = np.int32,
+		count = len(values),
+	)
+	return codes, list(categories.keys())
+
+
+class ClippingsTable(object):
+	"""columnar table of clippings
+
+	tables produced by `filter` and `sort` share the categories (and thus codes)
+	of the table they came from
+
+	### Columns:
+	 - `date_unix : np.ndarray[int64]`
+	 - `loc_start, loc_end : np.ndarray[int64]` (`-1` if the location is not numeric)
+	 - `clip_type : np.ndarray[int8]` (index into `CLIP_TYPES`)
+	 - `title_code, author_code : np.ndarray[int32]` (index into `titles`, `authors`)
+	 - `location, date, text_highlight, text_note : np.ndarray[object]` (side arrays)
+	"""
+
+	NUMERIC_COLUMNS : Tuple[str, ...] = (
+		'date_unix', 'loc_start', 'loc_end', 'clip_type', 'title_code', 'author_code',
+	)
+	OBJECT_COLUMNS : Tuple[str, ...] = (
+		'location', 'date', 'text_highlight', 'text_note',
+	)
+
+	def __init__(
+			self,
+			columns : Dict[str, np.ndarray],
+			titles : List[str],
+			authors : List[str],
+		) -> None:
+		self.columns : Dict[str, np.ndarray] = columns
+		self.titles : List[str] = titles
+		self.authors : List[str] = authors
+
+	@classmethod
+	def from_clippings(cls, clippings : List[ClippingsItem]) -> 'ClippingsTable':
+		"""build a table from a list of parsed clippings"""
+		n : int = len(clippings)
+		title_code, titles = _encode_categorical([ x.title for x in clippings ])
+		author_code, authors = _encode_categorical([ x.author for x in clippings ])
+		locations : np.ndarray = np.array(
+			[ parse_location_range(x.location) for x in clippings ],
+			dtype = np.int64,
+		).reshape(n, 2)
+		clip_type_idx : Dict[str, int] = { t : i for i, t in enumerate(CLIP_TYPES) }
+
+		def _obj_array(values : List[Any]) -> np.ndarray:
+			# filling an empty array avoids numpy trying to build nested arrays
+			arr : np.ndarray = np.empty(n, dtype = object)
+			arr[:] = values
+			return arr
+
+		return cls(
+			columns = {
+				'date_unix' : np.fromiter((x.date_unix for x in clippings), dtype = np.int64, count = n),
+				'loc_start' : locations[:, 0],
+				'loc_end' : locations[:, 1],
+				'clip_type' : np.fromiter((clip_type_idx[x.clip_type] for x in clippings), dtype = np.int8, count = n),
+				'title_code' : title_code,
+				'author_code' : author_code,
+				'location' : _obj_array([ x.location for x in clippings ]),
+				'date' : _obj_array([ x.date for x in clippings ]),
+				'text_highlight' : _obj_array([ x.text_highlight for x in clippings ]),
+				'text_note' : _obj_array([ x.text_note for x in clippings ]),
+			},
+			titles = titles,
+			authors = authors,
+		)
+
+	def __len__(self) -> int:
+		return len(self.columns['date_unix'])
+
+	def __getitem__(self, column : str) -> np.ndarray:
+		return self.columns[column]
+
+	def take(self, indices : np.ndarray) -> 'ClippingsTable':
+		"""new table with the rows at `indices` (or a boolean mask), in that order"""
+		return ClippingsTable(
+			columns = { k : v[indices] for k, v in self.columns.items() },
+			titles = self.titles,
+			authors = self.authors,
+		)
+
+	def filter(
+			self,
+			mask : Optional[np.ndarray] = None,
+			title : Optional[str] = None,
+			author : Optional[str] = None,
+			clip_type : Optional[ClippingsType] = None,
+			date_from : Optional[int] = None,
+			date_to : Optional[int] = None,
+		) -> 'ClippingsTable':
+		"""filter rows by a boolean mask and/or exact title, author, clip type, or date range (`[date_from, date_to)`)"""
+		# copied, since the filters below update `keep` in place
+		keep : np.ndarray = np.ones(len(self), dtype = bool) if mask is None else np.array(mask, dtype = bool)
+		if title is not None:
+			keep &= self.columns['title_code'] == (self.titles.index(title) if title in self.titles else -1)
+		if author is not None:
+			keep &= self.columns['author_code'] == (self.authors.index(author) if author in self.authors else -1)
+		if clip_type is not None:
+			keep &= self.columns['clip_type'] == CLIP_TYPES.index(clip_type)
+		if date_from is not None:
+			keep &= self.columns['date_unix'] >= date_from
+		if date_to is not None:
+			keep &= self.columns['date_unix'] < date_to
+		return self.take(keep)
+
+	def sort(self, by : Union[str, Sequence[str]] = 'date_unix') -> 'ClippingsTable':
+		"""stable sort by one or more numeric columns, the first column being the primary key"""
+		if isinstance(by, str):
+			by = [by]
+		# `np.lexsort` uses the last key as the primary one
+		order : np.ndarray = np.lexsort([ self.columns[k] for k in reversed(by) ])
+		return self.take(order)
+
+	def group_indices(self, by : str = 'title_code') -> Dict[int, np.ndarray]:
+		"""map each code of the column `by` to the row indices in that group, keeping row order within groups"""
+		codes : np.ndarray = self.columns[by]
+		order : np.ndarray = np.argsort(codes, kind = 'stable')
+		unique_codes, starts = np.unique(codes[order], return_index = True)
+		return {
+			int(code) : idxs
+			for code, idxs in zip(unique_codes, np.split(order, starts[1:]))
+		}
+
+	def to_clippings(self) -> List[ClippingsItem]:
+		"""rebuild the list of `ClippingsItem`s"""
+		cols = self.columns
+		return [
+			ClippingsItem(
+				title = self.titles[cols['title_code'][i]],
+				author = self.authors[cols['author_code'][i]],
+				location = cols['location'][i],
+				clip_type = CLIP_TYPES[cols['clip_type'][i]],
+				date = cols['date'][i],
+				date_unix = int(cols['date_unix'][i]),
+				text_highlight = cols['text_highlight'][i],
+				text_note = cols['text_note'][i],
+			)
+			for i in range(len(self))
+		]
+
+	def to_bybook(self) -> Dict[str, List[ClippingsItem]]:
+		"""same output as `sort_clippings_by_book`: books in order of first appearance, clippings in row order"""
+		groups : Dict[int, np.ndarray] = self.group_indices('title_code')
+		# order books by their first row
+		codes_ordered : List[int] = sorted(groups.keys(), key = lambda c : groups[c][0])
+		return {
+			self.titles[code] : self.take(groups[code]).to_clippings()
+			for code in codes_ordered
+		}
+
+	# aggregates
+	# ==================================================
+
+	def count_by_book(self) -> Dict[str, int]:
+		"""number of clippings per book"""
+		counts : np.ndarray = np.bincount(self.columns['title_code'], minlength = len(self.titles))
+		return {
+			self.titles[code] : int(n)
+			for code, n in enumerate(counts)
+			if n > 0
+		}
+
+	def count_by_book_month(self) -> Dict[Tuple[str, str], int]:
+		"""number of clippings per `(book, 'YYYY-MM')`, months in UTC"""
+		months : np.ndarray = self.columns['date_unix'].astype('datetime64[s]').astype('datetime64[M]')
+		keys : np.ndarray = np.empty(len(self), dtype = [('title_code', np.int32), ('month', 'datetime64[M]')])
+		keys['title_code'] = self.columns['title_code']
+		keys['month'] = months
+		unique_keys, counts = np.unique(keys, return_counts = True)
+		return {
+			(self.titles[k['title_code']], str(k['month'])) : int(n)
+			for k, n in zip(unique_keys, counts)
+		}
+
+	def reading_sessions(self, gap : int = READING_SESSION_GAP) -> np.ndarray:
+		"""detect reading sessions: runs of clippings with less than `gap` seconds between consecutive ones
+
+		### Returns:
+		 - `np.ndarray`
+		   structured array with fields `start`, `end` (unix times) and `count`, one row per session
+		"""
+		dates : np.ndarray = np.sort(self.columns['date_unix'])
+		out : np.ndarray = np.empty(0, dtype = [('start', np.int64), ('end', np.int64), ('count', np.int64)])
+		if len(dates) == 0:
+			return out
+		# a new session starts at index 0 and after every large gap
+		starts : np.ndarray = np.concatenate([[0], np.flatnonzero(np.diff(dates) >= gap) + 1])
+		ends : np.ndarray = np.concatenate([starts[1:], [len(dates)]])
+		out = np.empty(len(starts), dtype = out.dtype)
+		out['start'] = dates[starts]
+		out['end'] = dates[ends - 1]
+		out['count'] = ends - starts
+		return out
+
+	def location_coverage(self) -> Dict[str, Tuple[int, int]]:
+		"""per book, `(covered, max_location)`: number of distinct locations inside some clipping, and the largest location seen
+
+		clippings without numeric locations are ignored
+		"""
+		output : Dict[str, Tuple[int, int]] = dict()
+		for code, idxs in self.group_indices('title_code').items():
+			starts : np.ndarray = self.columns['loc_start'][idxs]
+			ends : np.ndarray = self.columns['loc_end'][idxs]
+			valid : np.ndarray = starts >= 0
+			if not valid.any():
+				continue
+			starts, ends = starts[valid], ends[valid]
+			max_loc : int = int(ends.max())
+			# difference array marking where each clipping starts and stops covering
+			delta : np.ndarray = np.zeros(max_loc + 2, dtype = np.int64)
+			np.add.at(delta, starts, 1)
+			np.add.at(delta, np.maximum(ends, starts) + 1, -1)
+			covered : int = int(np.count_nonzero(np.cumsum(delta)[:max_loc + 1] > 0))
+			output[self.titles[code]] = (covered, max_loc)
+		return output
@@ -0,0 +1,203 @@
+"""zero-copy tokenizer over a memory-mapped clippings file
+
+the file is `mmap`ed and never decoded as a whole. separators and header lines are found
+with `find` on the raw bytes, and only the title, author and metadata lines are decoded.
+the highlight/note text is kept as a `memoryview` into the map, and decoded on first
+access -- so workloads that only need metadata (counting, grouping) never decode it.
+"""
+
+from typing import *
+import gzip
+import mmap
+
+from util.clippingsitem import (
+	ClippingsType, ClippingsItem,
+	CLIPPINGS_FILENAME, MARKERS,
+	parse_titleauthor, parse_meta,
+)
+
+BOM_BYTES : bytes = b'\xef\xbb\xbf'
+ITEM_SPLIT_BYTES : bytes = MARKERS['item_split'].encode('utf-8')
+_WHITESPACE_BYTES : bytes = b' \t\r\n'
+
+
+class LazyClippingsItem(object):
+	"""a clipping with eagerly parsed metadata, whose text is decoded only when accessed
+
+	has the same attributes as `ClippingsItem`, and can be converted with `to_item`
+	"""
+
+	__slots__ = (
+		'title', 'author', 'location', 'clip_type', 'date', 'date_unix',
+		'_text_raw', '_text',
+	)
+
+	def __init__(
+			self,
+			title : str,
+			author : str,
+			location : str,
+			clip_type : ClippingsType,
+			date : str,
+			date_unix : int,
+			text_raw : memoryview,
+		) -> None:
+		self.title : str = title
+		self.author : str = author
+		self.location : str = location
+		self.clip_type : ClippingsType = clip_type
+		self.date : str = date
+		self.date_unix : int = date_unix
+		self._text_raw : Optional[memoryview] = text_raw
+		self._text : Optional[str] = None
+
+	@property
+	def text(self) -> str:
+		"""the decoded text of the clipping, decoded on first access"""
+		if self._text is None:
+			self._text = str(self._text_raw, 'utf-8').strip()
+			# release the view, so the map can be closed once nothing else needs it
+			self._text_raw = None
+		return self._text
+
+	@property
+	def text_highlight(self) -> Optional[str]:
+		return self.text if self.clip_type == 'Highlight' else None
+
+	@property
+	def text_note(self) -> Optional[str]:
+		return self.text if self.clip_type == 'Note' else None
+
+	def to_item(self) -> ClippingsItem:
+		return ClippingsItem(
+			title = self.title,
+			author = self.author,
+			location = self.location,
+			clip_type = self.clip_type,
+			date = self.date,
+			date_unix = self.date_unix,
+			text_highlight = self.text_highlight,
+			text_note = self.text_note,
+		)
+
+	def __repr__(self) -> str:
+		return f'LazyClippingsItem(title={self.title!r}, author={self.author!r}, location={self.location!r}, clip_type={self.clip_type!r}, date_unix={self.date_unix!r})'
+
+
+def _skip_whitespace(buf : Union[bytes, mmap.mmap], pos : int, end : int) -> int:
+	while (pos < end) and (buf[pos] in _WHITESPACE_BYTES):
+		pos += 1
+	return pos
+
+
+def _next_line(buf : Union[bytes, mmap.mmap], pos : int, end : int) -> Tuple[int, int]:
+	"""`(line_end, next_pos)` of the line starting at `pos`, not going past `end`"""
+	idx : int = buf.find(b'\n', pos, end)
+	if idx == -1:
+		return (end, end)
+	return (idx, idx + 1)
+
+
+def parse_clippings_entry(
+		buf : Union[bytes, mmap.mmap],
+		view : memoryview,
+		start : int,
+		end : int,
+		titleauthor_cache : Optional[Dict[bytes, Tuple[str, str]]] = None,
+	) -> Optional[LazyClippingsItem]:
+	"""parse the entry in `buf[start:end]`, or `None` if it is empty
+
+	`view` is a memoryview of `buf`, used to slice out the text without copying.
+	`titleauthor_cache` maps raw title lines to their parsed `(title, author)`, so
+	the clippings of a book are decoded once and share their strings
+	"""
+	start = _skip_whitespace(buf, start, end)
+	if start >= end:
+		return None
+
+	# the byte order mark, which entries may or may not have
+	if buf[start : start + len(BOM_BYTES)] == BOM_BYTES:
+		start += len(BOM_BYTES)
+
+	# title and author line
+	line_end, pos = _next_line(buf, start, end)
+	if titleauthor_cache is None:
+		title, author = parse_titleauthor(str(view[start:line_end], 'utf-8'))
+	else:
+		line_raw : bytes = buf[start:line_end]
+		if line_raw not in titleauthor_cache:
+			titleauthor_cache[line_raw] = parse_titleauthor(str(line_raw, 'utf-8'))
+		title, author = titleauthor_cache[line_raw]
+
+	# metadata line
+	meta_start : int = _skip_whitespace(buf, pos, end)
+	line_end, pos = _next_line(buf, meta_start, end)
+	clip_type, location, date, date_unix = parse_meta(str(view[meta_start:line_end], 'utf-8'))
+
+	if clip_type not in ('Highlight', 'Note'):
+		raise KeyError(f'unknown clip type {clip_type}')
+
+	return LazyClippingsItem(
+		title = title,
+		author = author,
+		location = location,
+		clip_type = clip_type,
+		date = date,
+		date_unix = date_unix,
+		text_raw = view[pos:end],
+	)
+
+
+def iter_clippings_spans(buf : Union[bytes, mmap.mmap]) -> Iterator[Tuple[int, int, LazyClippingsItem]]:
+	"""iterate over `(start, stop, item)` for the entries of a clippings file held in `buf`
+
+	`buf[start:stop]` is the raw entry, including its separator line, so entries can be
+	copied elsewhere byte for byte
+	"""
+	view : memoryview = memoryview(buf)
+	pos : int = 0
+	n : int = len(buf)
+	titleauthor_cache : Dict[bytes, Tuple[str, str]] = dict()
+	while pos < n:
+		end : int = buf.find(ITEM_SPLIT_BYTES, pos)
+		if end == -1:
+			end = stop = n
+		else:
+			stop = _next_line(buf, end, n)[1]
+		item : Optional[LazyClippingsItem] = parse_clippings_entry(buf, view, pos, end, titleauthor_cache)
+		if item is not None:
+			yield (pos, stop, item)
+		pos = stop
+
+
+def iter_clippings_buffer(buf : Union[bytes, mmap.mmap]) -> Iterator[LazyClippingsItem]:
+	"""iterate over the entries of a clippings file held in `buf`, without decoding their text"""
+	for _, _, item in iter_clippings_spans(buf):
+		yield item
+
+
+def parse_clippings_file_lazy(filename : str = CLIPPINGS_FILENAME) -> List[LazyClippingsItem]:
+	"""parses a clippings file via `mmap`, leaving the text of each item undecoded until accessed
+
+	notes are not merged, since that needs their text. the map stays open as long as
+	any item with undecoded text is alive. `.gz` files (archive segments) can't be
+	mapped, so they are decompressed into memory instead
+
+	### Parameters:
+	 - `filename : str`   
+	   (defaults to `CLIPPINGS_FILENAME`)
+	
+	### Returns:
+	 - `List[LazyClippingsItem]` 
+	"""
+	if filename.endswith('.gz'):
+		with gzip.open(filename, 'rb') as f:
+			return list(iter_clippings_buffer(f.read()))
+
+	with open(filename, 'rb') as f:
+		# empty files can't be mapped
+		if f.seek(0, 2) == 0:
+			return []
+		buf : mmap.mmap = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+	return list(iter_clippings_buffer(buf))
@@ -8,10 +8,9 @@ from typing import *
 import json
 import sys
 import os
-
-import urllib3
-from pyzotero import zotero
-from pyzotero.zotero_errors import PyZoteroError
+import hashlib
+import mimetypes
+import concurrent.futures
 
 from util.clippingsitem import (
 	ClippingsType, ClippingsItem,
@@ -21,9 +20,16 @@ from util.export import (
 	grab_title_author, ClippingsItem_lst_md,ClippingsItem_to_filename,
 	DATA_EXPORT_PATH,
 )
+from util.render import CompiledTemplate, get_template
+from util.zotero_client import ZoteroClient, ZoteroAPIError
+from util.journal import UploadJournal, ZOTERO_UPLOAD_JOURNAL_FILE
 
 ZOTERO_KINDLE_CACHE_FILE : str = '../zotero_kindle_cache.json'
 ZOTERO_API_DATA_FILE : str = '__zotero_api__.json'
+ZOTERO_NOTES_MAP_FILE : str = '../zotero_kindle_notes.json'
+
+# how many unresolved books ahead to search for Zotero items in the background
+ZOTERO_PREFETCH_DEPTH : int = 4
 
 
 
@@ -56,6 +62,11 @@ def ZKCacheKey_tostr(key : ZKCacheKey) -> str:
 	"""convert `ZKCacheKey` to string"""
 	return ' | '.join(key)
 
+def zk_cache_load() -> Dict[str, ZKCacheValue]:
+	"""load the whole zotero kindle cache, keyed by `ZKCacheKey_tostr`"""
+	with open(ZOTERO_KINDLE_CACHE_FILE, 'r') as f:
+		return json.load(f)
+
 def zk_cache_get(key : ZKCacheKey) -> Optional[str]:
 	"""get a value from the zotero kindle cache"""
 	with open(ZOTERO_KINDLE_CACHE_FILE, 'r') as f:
@@ -99,6 +110,36 @@ def validate_zk_cache() -> bool:
 # validate the cache at runtime
 validate_zk_cache()
 
+
+# map from `ZKCacheKey_tostr` to the Zotero child note holding the clippings for that book
+ZKNoteEntry = TypedDict('ZKNoteEntry', {
+	'key' : ZoteroKey,
+	'version' : int,
+	'parent' : ZoteroKey,
+	'hash' : str,
+})
+
+def zk_notes_get(key : ZKCacheKey) -> Optional[ZKNoteEntry]:
+	"""get the child note entry for a book from the notes map"""
+	if not os.path.exists(ZOTERO_NOTES_MAP_FILE):
+		return None
+	with open(ZOTERO_NOTES_MAP_FILE, 'r') as f:
+		notes_map : dict = json.load(f)
+	return notes_map.get(ZKCacheKey_tostr(key), None)
+
+def zk_notes_set(key : ZKCacheKey, value : Optional[ZKNoteEntry]) -> None:
+	"""set (or remove, if `value` is `None`) the child note entry for a book in the notes map"""
+	notes_map : dict = dict()
+	if os.path.exists(ZOTERO_NOTES_MAP_FILE):
+		with open(ZOTERO_NOTES_MAP_FILE, 'r') as f:
+			notes_map = json.load(f)
+	if value is None:
+		notes_map.pop(ZKCacheKey_tostr(key), None)
+	else:
+		notes_map[ZKCacheKey_tostr(key)] = value
+	with open(ZOTERO_NOTES_MAP_FILE, 'w') as f:
+		json.dump(notes_map, f, indent = '\t')
+
 def string_minimize(s : str) -> str:
 	s_trim : str = (
 		s
@@ -166,41 +207,28 @@ def ZKCacheKey_from_item_raw(item_raw : dict) -> ZKCacheKey:
 
 class ZoteroManager(object):
 	def __init__(self) -> None:
-		self.https = urllib3.PoolManager()
 		with open(ZOTERO_API_DATA_FILE, 'r') as f:
 			self.api_data : dict = json.load(f)
 			self.api_key : str = self.api_data['key']
 			self.url : str = self.api_data['url']
-			self.pyzot : zotero.Zotero = zotero.Zotero(
-				self.get_library_id(),
-				self.get_library_type(),
-				self.api_key,
-			)
+		# all requests go through this client, see `util.zotero_client`
+		self.client : ZoteroClient = ZoteroClient(self.api_key, self.get_library_url())
 	
 	def get_raw(self, item_key : ZoteroKey, top_only : bool = True) -> dict:
-		"""get raw item info from zotero api"""
-		
-		# get the item
-		r = self.https.request(
-			'GET', self.url + ('/top' if top_only else ''),
-			headers = {
-				'Zotero-API-Key' : self.api_key,
-				'itemKey' : item_key,
-			},
-		)
+		"""get raw item info from zotero api
 
-		data_str : str = r.data.decode('utf-8')
-		if data_str.lower() == 'not found':
-			raise KeyError(f'item {item_key} not found')
-		data_lst : list = json.loads(data_str)
+		`top_only` is kept for compatibility, the item is fetched directly by its key
+		"""
+		item_raw : dict = self.client.get_json(f'/items/{item_key}')
+		if item_raw['key'] != item_key:
+			raise KeyError(f'item {item_key} returned a result, but key does not match:\n\n\n{item_raw}')
+		return item_raw
 
-		# get the item with the correct key
-		for item_raw in data_lst:
-			if item_raw['data']['key'] == item_key:
-				return item_raw
-		
-		# raise error if not found
-		raise KeyError(f'item {item_key} returned results, but key not found in them:\n\n\n{data_lst}')
+	def get_library_url(self) -> str:
+		"""base url of the library, i.e. `https://api.zotero.org/users/<id>`"""
+		if '/items' in self.url:
+			return self.url[:self.url.index('/items')]
+		return self.url.rstrip('/')
 
 	def get_library_type(self) -> str:
 		if 'users' in self.url:
@@ -227,23 +255,19 @@ class ZoteroManager(object):
 		item_raw = self.get_raw(item_key)
 		return ZKCacheKey_from_item_raw(item_raw)
 
-	def search_raw(self, query : str, top_only : bool = True) -> list:
-		r = self.https.request(
-			'GET', 
-			self.url + ('/top' if top_only else ''), 
-			headers = {'Zotero-API-Key': self.api_key, 'q' : query},
+	def iter_search(self, query : str, top_only : bool = True, **params) -> Iterator[dict]:
+		"""iterate over all items matching `query`, fetching pages lazily. extra `params` are passed to the api"""
+		return self.client.iter_pages(
+			'/items' + ('/top' if top_only else ''),
+			params = {'q' : query, **params},
 		)
-		return json.loads(r.data.decode('utf-8'))
 
-	def search_title_exact(self, title : str, top_only : bool = True) -> Optional[dict]:
-		r = self.https.request(
-			'GET', 
-			self.url + ('/top' if top_only else ''), 
-			headers = {'Zotero-API-Key': self.api_key, 'q' : title},
-		)
-		res = json.loads(r.data.decode('utf-8'))
-		# print(json.dumps(res, indent=2))
-		for item in res:
+	def search_raw(self, query : str, top_only : bool = True) -> list:
+		return list(self.iter_search(query, top_only))
+
+	def search_title_exact(self, title : str, top_only : bool = True, **params) -> Optional[dict]:
+		# stops fetching pages as soon as a match is found
+		for item in self.iter_search(title, top_only, **params):
 			if ('title' in item['data']) and (item['data']['title'] == title):
 				return item
 		return None
@@ -268,50 +292,270 @@ class ZoteroManager(object):
 		find possible keys for a given cache key
 		"""
 		zot_keys : Dict[ZoteroKey,str] = {}
-		query_results = self.search_raw(string_minimize(cache_key.title))
-		for item_raw in query_results:
+		for item_raw in self.iter_search(string_minimize(cache_key.title)):
 			key = ZoteroKey(item_raw['key'])
 			if key not in zot_keys:
 				zot_keys[key] = ZKCacheKey_from_item_raw(item_raw)
 		return zot_keys
 
-	def upload_attachment(self, filepath : str, parentID : ZoteroKey) -> tuple:
-		"""upload an attachment to zotero"""
-		# TODO: this is really inefficient, but it works for now
+	@staticmethod
+	def attachment_metadata(filepath : str, parentID : ZoteroKey) -> dict:
+		"""metadata for a new `kindleclip_*` attachment item for `filepath`"""
+		return {
+			'itemType' : 'attachment',
+			'linkMode' : 'imported_file',
+			'parentItem' : parentID,
+			'title' : 'kindleclip_' + os.path.basename(filepath),
+			'contentType' : mimetypes.guess_type(filepath)[0] or 'text/plain',
+			'charset' : 'utf-8',
+			'filename' : os.path.basename(filepath),
+			'tags' : [],
+		}
+
+	def create_attachment(self, filepath : str, parentID : ZoteroKey) -> tuple:
+		"""create an attachment item under `parentID` and upload `filepath` to it"""
+		res : dict = self.client.create_items([self.attachment_metadata(filepath, parentID)])['0']
+		if 'failed' in res:
+			return (None, 'failure')
+		return ( res['key'], self.client.upload_file(res['key'], filepath) )
+
+	def find_attachments(self, title : str, parentID : ZoteroKey) -> List[dict]:
+		"""all attachments of `parentID` with the exact title `title`"""
+		return [
+			item
+			for item in self.client.iter_pages(f'/items/{parentID}/children', params = {'itemType' : 'attachment'})
+			if item['data'].get('title', None) == title
+		]
+
+	def delete_attachments(self, items : List[dict]) -> None:
+		"""delete attachment items, skipping (with a warning) any modified since they were fetched"""
+		for item in items:
+			print(f"    deleting existing attachment {item['key']}")
+			if not self.client.delete_item(item['key'], item['version']):
+				print(f"    WARNING: attachment {item['key']} was modified in Zotero, not deleting it")
+
+	def upload_attachment(
+			self,
+			filepath : str,
+			parentID : ZoteroKey,
+			journal : Optional[UploadJournal] = None,
+			journal_key : Optional[str] = None,
+		) -> tuple:
+		"""upload an attachment to zotero, replacing any existing attachment with the same title
+
+		the new attachment is uploaded before the old ones are deleted, so an interruption
+		never leaves the item without an attachment. every existing attachment with the same
+		title is deleted, so stray uploads from an interrupted run are also cleaned up.
+		if `journal` is given, the upload is recorded under `journal_key` before deleting
+		"""
 		# OPTIMIZE: upload all attachments at once
-		# OPTIMIZE: instead of always deleting file, hash both files and skip if identical
 
-		metadata = self.pyzot._attachment_template("imported_file").copy()
-		metadata["title"] = 'kindleclip_' + os.path.basename(filepath)
-		metadata["filename"] = filepath
+		title : str = 'kindleclip_' + os.path.basename(filepath)
 
-		# if file already exists, delete it first
-		item_exists : Optional[dict] = self.search_title_exact(metadata["title"], top_only = False)
 		try:
-			if item_exists is not None:
-				print(f"    deleting existing attachment {item_exists['key']}")
-				self.pyzot.delete_item([item_exists])
+			items_existing : List[dict] = self.find_attachments(title, parentID)
 
-			res = self.pyzot._attachment([metadata], parentID)
-			
-			res_key = [
-				x 
-				for x in ['success', 'failure', 'unchanged']
-				if len(res[x]) > 0
-			].pop()
-
-			return ( res[res_key][0]['key'], res_key )
-		except PyZoteroError as e:
+			res_key, res_status = self.create_attachment(filepath, parentID)
+			if res_key is None:
+				return (None, res_status)
+			if journal is not None:
+				journal.record(journal_key, 'uploaded', key = res_key)
+
+			self.delete_attachments([ x for x in items_existing if x['key'] != res_key ])
+
+			return ( res_key, res_status )
+		except ZoteroAPIError as e:
 			print(f"    error uploading attachment: {e}")
 			return (None, 'error')
 
+	def finish_attachment(self, filepath : str, parentID : ZoteroKey, new_key : ZoteroKey) -> None:
+		"""finish an interrupted `upload_attachment` whose new attachment `new_key` was already uploaded"""
+		title : str = 'kindleclip_' + os.path.basename(filepath)
+		self.delete_attachments([
+			x
+			for x in self.find_attachments(title, parentID)
+			if x['key'] != new_key
+		])
+
+	def create_note(self, note_html : str, parentID : ZoteroKey) -> Tuple[ZoteroKey, int]:
+		"""create a child note under `parentID`, returning its key and version"""
+		res : dict = self.client.create_items([{
+			'itemType' : 'note',
+			'parentItem' : parentID,
+			'note' : note_html,
+			'tags' : [{'tag' : 'kindleclip'}],
+		}])['0']
+		if 'failed' in res:
+			raise ZoteroAPIError(f'could not create note under {parentID}: {res["failed"]}')
+		return ( res['key'], res['version'] )
+
+	def update_note(self, note_key : ZoteroKey, note_html : str, version : int) -> Tuple[str, Optional[int]]:
+		"""PATCH the contents of the note `note_key`, only if it is still at `version`
+
+		### Returns:
+		 - `Tuple[str, Optional[int]]`
+		   status (`'success'`, `'conflict'` if modified remotely, `'missing'` if deleted remotely)
+		   and the new version
+		"""
+		r = self.client.request(
+			'PATCH', f'/items/{note_key}',
+			headers = {'If-Unmodified-Since-Version' : str(version)},
+			json_body = {'note' : note_html},
+		)
+		if r.status == 204:
+			return ( 'success', int(r.headers['Last-Modified-Version']) )
+		elif r.status == 412:
+			return ( 'conflict', None )
+		elif r.status == 404:
+			return ( 'missing', None )
+		raise ZoteroAPIError(f'could not update note {note_key}: {r.status} {r.data.decode("utf-8")}')
+
+	def upsert_note(self, cache_key : ZKCacheKey, note_html : str, parentID : ZoteroKey) -> tuple:
+		"""store `note_html` as a child note of `parentID`, updating the existing note in place if there is one
+
+		the note key and version are kept in `ZOTERO_NOTES_MAP_FILE`, so no search is needed.
+		unchanged notes make no requests at all. if the note was edited in Zotero since we
+		last wrote it, it is left alone and `'conflict'` is returned
+		"""
+		content_hash : str = hashlib.sha256(note_html.encode('utf-8')).hexdigest()
+		entry : Optional[ZKNoteEntry] = zk_notes_get(cache_key)
+
+		try:
+			if (entry is not None) and (entry['parent'] == parentID):
+				if entry['hash'] == content_hash:
+					return ( entry['key'], 'unchanged' )
+
+				status, version = self.update_note(entry['key'], note_html, entry['version'])
+				if status == 'success':
+					zk_notes_set(cache_key, ZKNoteEntry(key = entry['key'], version = version, parent = parentID, hash = content_hash))
+					return ( entry['key'], status )
+				elif status == 'conflict':
+					print(f"    note {entry['key']} was modified in Zotero since it was last uploaded, not overwriting it")
+					return ( entry['key'], status )
+				# if missing, fall through and recreate it
+				print(f"    note {entry['key']} was deleted in Zotero, recreating it")
+
+			note_key, version = self.create_note(note_html, parentID)
+			zk_notes_set(cache_key, ZKNoteEntry(key = note_key, version = version, parent = parentID, hash = content_hash))
+			return ( note_key, 'success' )
+		except ZoteroAPIError as e:
+			print(f"    error uploading note: {e}")
+			return (None, 'error')
+
+
+class PossibleKeysPrefetcher(object):
+	"""runs `find_possible_keys` in the background for upcoming unresolved books
+
+	while the user answers the prompt for one book, the searches for it and the next
+	`depth` unresolved books are already running, so the candidates are usually ready
+	by the time they are shown. searches run one at a time on a single worker thread,
+	so at most one extra request is in flight, and it waits on the client's rate
+	limiting (`Backoff`/`Retry-After`) like any other request
+	"""
+
+	def __init__(
+			self,
+			zotero_manager : ZoteroManager,
+			cache_keys : Iterable[ZKCacheKey],
+			depth : int = ZOTERO_PREFETCH_DEPTH,
+		) -> None:
+		self.zotero_manager : ZoteroManager = zotero_manager
+		# unresolved books, in the order they will be prompted for
+		self.cache_keys : List[ZKCacheKey] = list(dict.fromkeys(cache_keys))
+		self.depth : int = depth
+		self._position : Dict[ZKCacheKey, int] = { k : i for i, k in enumerate(self.cache_keys) }
+		self._futures : Dict[ZKCacheKey, concurrent.futures.Future] = dict()
+		self._pool : Optional[concurrent.futures.ThreadPoolExecutor] = (
+			concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix = 'zotero_prefetch')
+			if depth > 0 else None
+		)
+
+	@classmethod
+	def for_books(
+			cls,
+			zotero_manager : ZoteroManager,
+			data : Iterable[List[ClippingsItem]],
+			depth : int = ZOTERO_PREFETCH_DEPTH,
+		) -> 'PossibleKeysPrefetcher':
+		"""prefetcher for the books in `data` whose Zotero item is unknown or postponed, in order"""
+		cache : Dict[str, ZKCacheValue] = zk_cache_load()
+		cache_keys : List[ZKCacheKey] = list()
+		for items in data:
+			cache_key : ZKCacheKey = ZKCacheKey(*grab_title_author(items))
+			if cache.get(ZKCacheKey_tostr(cache_key), None) in (None, 0):
+				cache_keys.append(cache_key)
+		return cls(zotero_manager, cache_keys, depth)
+
+	def advance(self, cache_key : ZKCacheKey) -> None:
+		"""start searching for `cache_key` and the `depth` unresolved books after it, if not already started"""
+		if self._pool is None:
+			return
+		upcoming : List[ZKCacheKey] = [cache_key]
+		if cache_key in self._position:
+			idx : int = self._position[cache_key]
+			upcoming.extend(self.cache_keys[idx + 1 : idx + 1 + self.depth])
+		for key in upcoming:
+			if key not in self._futures:
+				self._futures[key] = self._pool.submit(self.zotero_manager.find_possible_keys, key)
+
+	def get(self, cache_key : ZKCacheKey) -> Dict[ZoteroKey,ZKCacheKey]:
+		"""possible keys for `cache_key`, waiting for the background search if it is still running"""
+		self.advance(cache_key)
+		future : Optional[concurrent.futures.Future] = self._futures.pop(cache_key, None)
+		if future is not None:
+			try:
+				return future.result()
+			except ZoteroAPIError as e:
+				print(f'  WARNING: background search for "{cache_key.title}" failed, retrying: {e}')
+		return self.zotero_manager.find_possible_keys(cache_key)
+
+	def close(self) -> None:
+		"""stop the worker, dropping searches which have not started"""
+		if self._pool is not None:
+			self._pool.shutdown(wait = False, cancel_futures = True)
+			self._pool = None
+
+	def __enter__(self) -> 'PossibleKeysPrefetcher':
+		return self
+
+	def __exit__(self, *args) -> None:
+		self.close()
+
 
 def zotero_upload_notes(
 		zotero_manager : ZoteroManager,
 		data : List[ClippingsItem], 
 		title : Optional[str] = None, author : Optional[str] = None,
-		export_func : Callable[[List[ClippingsItem]], str] = ClippingsItem_lst_md,
+		export_func : Union[Callable[[List[ClippingsItem]], str], str, CompiledTemplate] = ClippingsItem_lst_md,
+		notes_export : Union[None, str, Callable[[], str]] = None,
+		target : Literal['attachment', 'note'] = 'attachment',
+		journal : Optional[UploadJournal] = None,
+		prefetcher : Optional[PossibleKeysPrefetcher] = None,
+		interactive : bool = True,
 	) -> None:
+	"""upload the notes for a single book, prompting the user if the Zotero item is unknown
+
+	`export_func` is either a function rendering the items to a string, or a template
+	(by name, see `util.render.TEMPLATES`) which is streamed to the export file.
+	if `notes_export` is given, it is uploaded as-is instead of calling `export_func(data)`.
+	it can be a function returning the text, called only if the notes are uploaded
+
+	with `target='attachment'`, the notes are uploaded as a file attachment, replacing
+	the previous one. with `target='note'`, they are rendered as html into a Zotero
+	child note, which is updated in place on later uploads
+
+	if `journal` is given, attachment uploads are recorded in it: books already uploaded
+	with the same content are skipped, and interrupted uploads are finished
+
+	if `prefetcher` is given, the possible Zotero items for this and the next unresolved
+	books are searched for in the background while the user is prompted
+
+	if `interactive` is `False`, books whose Zotero item is unknown or postponed are
+	skipped instead of prompting, and left unknown or postponed
+	"""
+
+	if isinstance(export_func, str):
+		export_func = get_template(export_func)
 	
 	# get the title and author
 	title,author = grab_title_author(data)
@@ -321,7 +565,11 @@ def zotero_upload_notes(
 	cache_value : Optional[str] = zk_cache_get(cache_key)
 
 	# if bibtex key is unknown, or key is postponed, ask user what to do
-	if (cache_value is None) or (cache_value == 0):
+	if ((cache_value is None) or (cache_value == 0)) and (not interactive):
+		print(f'  ## skipping "{title}" by "{author}", bibtex key is unknown or postponed')
+	elif (cache_value is None) or (cache_value == 0):
+		if prefetcher is not None:
+			prefetcher.advance(cache_key)
 		print(f'  unknown bibtex key for "{title}" by "{author}", please select action from {ZK_CACHE_ACTIONS}:')
 		action : str = input('  > ')
 		if action in ZK_CACHE_ACTIONS:
@@ -338,7 +586,10 @@ def zotero_upload_notes(
 		# if add, then:
 		elif action == 'add':
 			# look in Zotero for items with matching author and title
-			possible_keys : Dict[ZoteroKey,ZKCacheKey] = zotero_manager.find_possible_keys(cache_key)
+			possible_keys : Dict[ZoteroKey,ZKCacheKey] = (
+				prefetcher.get(cache_key) if prefetcher is not None
+				else zotero_manager.find_possible_keys(cache_key)
+			)
 			print('# possible Zotero keys:')
 			for key,info in possible_keys.items():
 				print(
@@ -387,20 +638,78 @@ def zotero_upload_notes(
 	else:
 		if cache_value == -1:
 			print(f'  ## ignoring "{title}" by "{author}", bibtex key is unknown')
+		elif isinstance(cache_value, str) and (target == 'note'):
+			# zotero notes are html, so reuse `notes_export` only if it was rendered as html
+			if (notes_export is None) or (getattr(export_func, 'extension', None) != '.html'):
+				notes_export = get_template('html').render(data)
+			elif callable(notes_export):
+				notes_export = notes_export()
+			res = zotero_manager.upsert_note(cache_key, notes_export, cache_value)
+			print(f'  ## uploaded note: {cache_key=} {cache_value=} {res=}')
 		elif isinstance(cache_value, str):
 			# and then upload the notes
-			notes_export : str = export_func(data)
-			fname_export : str = '../zotero_export/' + ClippingsItem_to_filename(cache_key) + '.md'
+			extension : str = export_func.extension if isinstance(export_func, CompiledTemplate) else '.md'
+			fname_export : str = '../zotero_export/' + ClippingsItem_to_filename(cache_key) + extension
+			if callable(notes_export):
+				notes_export = notes_export()
 			with open(fname_export, 'w') as f:
-				f.write(notes_export)
-			res = zotero_manager.upload_attachment(fname_export, cache_value)
+				if notes_export is not None:
+					f.write(notes_export)
+				elif isinstance(export_func, CompiledTemplate):
+					export_func.render_to(data, f)
+				else:
+					f.write(export_func(data))
+
+			if journal is None:
+				res = zotero_manager.upload_attachment(fname_export, cache_value)
+				print(f'  ## uploaded: {cache_key=} {fname_export=} {cache_value=} {res=}')
+				return
+
+			journal_key : str = ZKCacheKey_tostr(cache_key)
+			with open(fname_export, 'rb') as f:
+				content_hash : str = hashlib.sha256(f.read()).hexdigest()
+
+			if journal.is_done(journal_key, content_hash, cache_value):
+				print(f'  ## already uploaded, skipping: {cache_key=}')
+				return
+
+			pending : Optional[dict] = journal.pending(journal_key)
+			if (
+				(pending is not None) 
+				and (pending['step'] == 'uploaded') 
+				and (pending['hash'] == content_hash) 
+				and (pending['parent'] == cache_value)
+			):
+				# the new attachment was uploaded, but the old ones might not have been deleted
+				print(f'  ## finishing interrupted upload: {cache_key=} {pending["key"]=}')
+				zotero_manager.finish_attachment(fname_export, cache_value, pending['key'])
+				journal.record(journal_key, 'done', key = pending['key'])
+				return
+
+			# otherwise, (re)do the upload from the start. this also cleans up after
+			# any upload which was interrupted before it could be recorded
+			journal.record(journal_key, 'begin', parent = cache_value, hash = content_hash)
+			res = zotero_manager.upload_attachment(fname_export, cache_value, journal = journal, journal_key = journal_key)
+			if res[0] is not None:
+				journal.record(journal_key, 'done', key = res[0])
 			print(f'  ## uploaded: {cache_key=} {fname_export=} {cache_value=} {res=}')
 
 def zotero_upload_all(
 		data_json_path : str = DATA_EXPORT_PATH,
 		zotero_manager : ZoteroManager = None,
-		export_func : Callable[[List[ClippingsItem]], str] = ClippingsItem_lst_md,
+		export_func : Union[Callable[[List[ClippingsItem]], str], str, CompiledTemplate] = ClippingsItem_lst_md,
+		target : Literal['attachment', 'note'] = 'attachment',
+		journal_path : Optional[str] = ZOTERO_UPLOAD_JOURNAL_FILE,
+		prefetch_depth : int = ZOTERO_PREFETCH_DEPTH,
 	) -> None:
+	"""upload the notes for every book in `data_json_path`
+
+	progress is recorded in the journal at `journal_path` (skipped if `None`), so an
+	interrupted run can be restarted and only does the remaining work
+
+	Zotero items for the next `prefetch_depth` unresolved books are searched for in
+	the background while prompting (`0` to disable), see `PossibleKeysPrefetcher`
+	"""
 
 	if zotero_manager is None:
 		zotero_manager = ZoteroManager()
@@ -412,8 +721,21 @@ def zotero_upload_all(
 			for k,v in data.items()
 		}
 
-	for title,items in data.items():
-		print(f'# uploading "{title}"')
-		zotero_upload_notes(zotero_manager, items, export_func = export_func)
+	journal : Optional[UploadJournal] = UploadJournal(journal_path) if journal_path is not None else None
+	prefetcher : PossibleKeysPrefetcher = PossibleKeysPrefetcher.for_books(zotero_manager, data.values(), prefetch_depth)
+	try:
+		for title,items in data.items():
+			print(f'# uploading "{title}"')
+			zotero_upload_notes(
+				zotero_manager, items, 
+				export_func = export_func, target = target, 
+				journal = journal, prefetcher = prefetcher,
+			)
+		if journal is not None:
+			journal.compact()
+	finally:
+		prefetcher.close()
+		if journal is not None:
+			journal.close()
 
 	return
@@ -0,0 +1,270 @@
+"""shared http client for the Zotero web api
+
+https://www.zotero.org/support/dev/web_api/v3/
+
+all `ZoteroManager` traffic goes through one `urllib3.PoolManager`, so connections are
+kept alive and reused. responses are requested gzipped, and paginated results are
+iterated lazily with `limit`/`start`. `Backoff` and `Retry-After` headers from the
+server are respected by every request, from every thread.
+"""
+
+from typing import *
+import hashlib
+import json
+import os
+import secrets
+import threading
+import time
+import urllib.parse
+
+import urllib3
+
+# maximum page size allowed by the Zotero api
+ZOTERO_PAGE_LIMIT : int = 100
+# maximum number of items per write or multi-item request
+ZOTERO_WRITE_LIMIT : int = 50
+
+ZOTERO_DEFAULT_PARAMS : Dict[str,str] = {
+	'format' : 'json',
+	'include' : 'data',
+}
+
+
+class ZoteroAPIError(Exception):
+	"""error response from the Zotero api"""
+	pass
+
+
+class ZoteroClient(object):
+	"""pooled, rate-limit aware client for a single Zotero library
+
+	### Parameters:
+	 - `api_key : str`
+	 - `library_url : str`
+	   i.e. `https://api.zotero.org/users/<id>`
+	 - `maxsize : int`
+	   number of connections kept alive per host
+	   (defaults to `4`)
+	 - `retries : int`
+	   retries on connection errors, `429` and `5xx` responses. only for `GET`, `HEAD`,
+	   `DELETE` (versioned, and a repeated delete finds the item gone) and writes with a
+	   `Zotero-Write-Token`. other writes are not retried, since if the response to a
+	   successful `PATCH` is lost, the retry would fail with `412` as if modified remotely
+	   (defaults to `3`)
+	"""
+
+	def __init__(
+			self,
+			api_key : str,
+			library_url : str,
+			maxsize : int = 4,
+			retries : int = 3,
+			timeout : float = 30.0,
+		) -> None:
+		self.library_url : str = library_url.rstrip('/')
+		self.headers : Dict[str,str] = {
+			'Zotero-API-Key' : api_key,
+			'Zotero-API-Version' : '3',
+			'Accept-Encoding' : 'gzip',
+		}
+		self.retries : urllib3.Retry = urllib3.Retry(
+			total = retries,
+			backoff_factor = 1.0,
+			status_forcelist = [429, 500, 502, 503, 504],
+			allowed_methods = frozenset({'GET', 'HEAD', 'DELETE'}),
+			respect_retry_after_header = True,
+			raise_on_status = False,
+		)
+		# the server ignores a repeated request with the same write token
+		self.retries_write_token : urllib3.Retry = self.retries.new(allowed_methods = None)
+		self.https : urllib3.PoolManager = urllib3.PoolManager(
+			maxsize = maxsize,
+			block = True,
+			timeout = timeout,
+			retries = self.retries,
+		)
+
+		# time before which no request may be sent, set from `Backoff`/`Retry-After`
+		self._not_before : float = 0.0
+		self._lock : threading.Lock = threading.Lock()
+
+	def url(self, path : str, params : Optional[Dict[str,Any]] = None) -> str:
+		"""absolute url for a path relative to the library, with query parameters"""
+		url : str = path if path.startswith('http') else self.library_url + path
+		if params:
+			url += '?' + urllib.parse.urlencode(params)
+		return url
+
+	def _wait_rate_limit(self) -> None:
+		with self._lock:
+			delay : float = self._not_before - time.time()
+		if delay > 0:
+			time.sleep(delay)
+
+	def _update_from_response(self, r : urllib3.BaseHTTPResponse) -> None:
+		backoff : Optional[str] = r.headers.get('Backoff') or r.headers.get('Retry-After')
+		if backoff is None:
+			return
+		with self._lock:
+			try:
+				self._not_before = max(self._not_before, time.time() + float(backoff))
+			except ValueError:
+				pass
+
+	def request(
+			self,
+			method : str,
+			path : str,
+			params : Optional[Dict[str,Any]] = None,
+			headers : Optional[Dict[str,str]] = None,
+			body : Union[None, bytes, str] = None,
+			json_body : Any = None,
+		) -> urllib3.BaseHTTPResponse:
+		"""send a request to the library, waiting out any backoff first"""
+		req_headers : Dict[str,str] = {**self.headers, **(headers or {})}
+		if json_body is not None:
+			body = json.dumps(json_body)
+			req_headers.setdefault('Content-Type', 'application/json')
+		if isinstance(body, str):
+			body = body.encode('utf-8')
+
+		retries : urllib3.Retry = self.retries_write_token if 'Zotero-Write-Token' in req_headers else self.retries
+		# a rate limited (`429`) request was not processed, so it is resent even if `retries` does not cover the method
+		resend_429 : bool = (retries.allowed_methods is not None) and (method not in retries.allowed_methods)
+		for attempt in range(retries.total + 1):
+			self._wait_rate_limit()
+			r = self.https.request(
+				method, self.url(path, params),
+				headers = req_headers,
+				body = body,
+				retries = retries,
+			)
+			self._update_from_response(r)
+			if (not resend_429) or (r.status != 429):
+				break
+		return r
+
+	def get_json(self, path : str, params : Optional[Dict[str,Any]] = None) -> Any:
+		"""GET a path and decode the json response. raises `KeyError` on `404`"""
+		r = self.request('GET', path, params = {**ZOTERO_DEFAULT_PARAMS, **(params or {})})
+		if r.status == 404:
+			raise KeyError(f'{path} not found')
+		if r.status != 200:
+			raise ZoteroAPIError(f'GET {path} failed: {r.status} {r.data.decode("utf-8")}')
+		return json.loads(r.data.decode('utf-8'))
+
+	def iter_pages(
+			self,
+			path : str,
+			params : Optional[Dict[str,Any]] = None,
+			limit : int = ZOTERO_PAGE_LIMIT,
+		) -> Iterator[dict]:
+		"""iterate over all results of a multi-item request, fetching one page at a time as needed"""
+		start : int = 0
+		while True:
+			r = self.request(
+				'GET', path,
+				params = {**ZOTERO_DEFAULT_PARAMS, **(params or {}), 'limit' : limit, 'start' : start},
+			)
+			if r.status != 200:
+				raise ZoteroAPIError(f'GET {path} failed: {r.status} {r.data.decode("utf-8")}')
+			page : List[dict] = json.loads(r.data.decode('utf-8'))
+			yield from page
+
+			start += len(page)
+			total : int = int(r.headers.get('Total-Results', start))
+			if (len(page) < limit) or (start >= total):
+				return
+
+	def create_items(self, items : List[dict]) -> Dict[str,dict]:
+		"""create items, in batches of `ZOTERO_WRITE_LIMIT`
+
+		each batch has a write token, so retried requests do not create duplicates
+
+		### Returns:
+		 - `Dict[str,dict]`
+		   maps the index (as a string, like the api) of each item in `items` to
+		   either the created item (with `key` and `version`), or `{'failed' : <reason>}`
+		"""
+		output : Dict[str,dict] = dict()
+		for offset in range(0, len(items), ZOTERO_WRITE_LIMIT):
+			batch : List[dict] = items[offset : offset + ZOTERO_WRITE_LIMIT]
+			r = self.request(
+				'POST', '/items',
+				headers = {'Zotero-Write-Token' : secrets.token_hex(16)},
+				json_body = batch,
+			)
+			if r.status != 200:
+				raise ZoteroAPIError(f'could not create items: {r.status} {r.data.decode("utf-8")}')
+			res : dict = json.loads(r.data.decode('utf-8'))
+			for idx, created in res.get('successful', dict()).items():
+				output[str(offset + int(idx))] = created
+			for idx, key in res.get('unchanged', dict()).items():
+				output[str(offset + int(idx))] = {'key' : key}
+			for idx, failure in res.get('failed', dict()).items():
+				output[str(offset + int(idx))] = {'failed' : failure}
+		return output
+
+	def delete_item(self, key : str, version : int) -> bool:
+		"""delete a single item, only if it is still at `version`. returns `False` if it was modified remotely"""
+		r = self.request(
+			'DELETE', f'/items/{key}',
+			headers = {'If-Unmodified-Since-Version' : str(version)},
+		)
+		if r.status in (204, 404):
+			return True
+		if r.status == 412:
+			return False
+		raise ZoteroAPIError(f'could not delete {key}: {r.status} {r.data.decode("utf-8")}')
+
+	def upload_file(self, key : str, filepath : str) -> str:
+		"""upload the contents of `filepath` to the (new) attachment item `key`
+
+		### Returns:
+		 - `str`
+		   `'success'`, or `'unchanged'` if the server already had the file
+		"""
+		with open(filepath, 'rb') as f:
+			content : bytes = f.read()
+
+		form_headers : Dict[str,str] = {
+			'Content-Type' : 'application/x-www-form-urlencoded',
+			'If-None-Match' : '*',
+		}
+
+		# get upload authorization
+		r = self.request(
+			'POST', f'/items/{key}/file',
+			headers = form_headers,
+			body = urllib.parse.urlencode({
+				'md5' : hashlib.md5(content).hexdigest(),
+				'filename' : os.path.basename(filepath),
+				'filesize' : len(content),
+				'mtime' : int(os.path.getmtime(filepath) * 1000),
+			}),
+		)
+		if r.status != 200:
+			raise ZoteroAPIError(f'could not get upload authorization for {key}: {r.status} {r.data.decode("utf-8")}')
+		auth : dict = json.loads(r.data.decode('utf-8'))
+		if auth.get('exists'):
+			return 'unchanged'
+
+		# upload the file itself. this goes to the storage server, so the api headers are not sent
+		self._wait_rate_limit()
+		r = self.https.request(
+			'POST', auth['url'],
+			headers = {'Content-Type' : auth['contentType']},
+			body = auth['prefix'].encode('utf-8') + content + auth['suffix'].encode('utf-8'),
+		)
+		if r.status != 201:
+			raise ZoteroAPIError(f'could not upload file for {key}: {r.status} {r.data.decode("utf-8")}')
+
+		# register the upload
+		r = self.request(
+			'POST', f'/items/{key}/file',
+			headers = form_headers,
+			body = urllib.parse.urlencode({'upload' : auth['uploadKey']}),
+		)
+		if r.status != 204:
+			raise ZoteroAPIError(f'could not register upload for {key}: {r.status} {r.data.decode("utf-8")}')
+		return 'success'
@@ -0,0 +1,323 @@
+"""plan/apply split for uploading clippings to Zotero
+
+`zotero_plan` decides, without writing anything to Zotero, what to do for every book:
+create a new attachment, replace an existing one, skip it because it is unchanged, or
+ignore it. the remote state is bulk-fetched in a few paginated requests, and the plan
+is saved as json so it can be reviewed.
+
+`zotero_apply` then executes a saved plan with no further lookups: attachment items are
+created in batches, files are uploaded in parallel, and old attachments are deleted
+(each only if it was not modified since planning).
+"""
+
+from typing import *
+import concurrent.futures
+import hashlib
+import json
+import os
+import time
+
+from util.clippingsitem import ClippingsItem
+from util.export import ClippingsItem_lst_md, ClippingsItem_to_filename, DATA_EXPORT_PATH
+from util.render import CompiledTemplate, get_template
+from util.journal import UploadJournal, ZOTERO_UPLOAD_JOURNAL_FILE
+from util.zotero_client import ZOTERO_WRITE_LIMIT, ZoteroAPIError
+from util.zotero import (
+	ZoteroKey, ZoteroManager, ZKCacheKey,
+	ZKCacheKey_tostr, zk_cache_load,
+)
+
+ZOTERO_PLAN_FILE : str = '../zotero_plan.json'
+ZOTERO_EXPORT_DIR : str = '../zotero_export/'
+
+PlanActionType = Literal['create', 'replace', 'skip', 'ignore', 'unresolved', 'missing_parent']
+
+
+def _file_hashes(filepath : str) -> Tuple[str, str]:
+	"""md5 (as stored by Zotero) and sha256 (as stored in the upload journal) of a file"""
+	with open(filepath, 'rb') as f:
+		content : bytes = f.read()
+	return hashlib.md5(content).hexdigest(), hashlib.sha256(content).hexdigest()
+
+
+def fetch_existing_attachments(zotero_manager : ZoteroManager) -> Dict[Tuple[ZoteroKey, str], List[dict]]:
+	"""all `kindleclip_*` attachments in the library, keyed by `(parent key, title)`
+
+	fetched in one paginated search, rather than one search per book
+	"""
+	output : Dict[Tuple[ZoteroKey, str], List[dict]] = dict()
+	for item in zotero_manager.iter_search('kindleclip_', top_only = False, itemType = 'attachment'):
+		title : str = item['data'].get('title', '')
+		parent : Optional[str] = item['data'].get('parentItem', None)
+		if title.startswith('kindleclip_') and (parent is not None):
+			output.setdefault((parent, title), list()).append(item)
+	return output
+
+
+def fetch_existing_keys(zotero_manager : ZoteroManager, keys : Iterable[ZoteroKey]) -> Set[ZoteroKey]:
+	"""which of `keys` exist in the library, using `format=keys` in batches of `ZOTERO_WRITE_LIMIT`"""
+	keys = sorted(set(keys))
+	existing : Set[ZoteroKey] = set()
+	for offset in range(0, len(keys), ZOTERO_WRITE_LIMIT):
+		r = zotero_manager.client.request(
+			'GET', '/items',
+			params = {
+				'itemKey' : ','.join(keys[offset : offset + ZOTERO_WRITE_LIMIT]),
+				'format' : 'keys',
+				'limit' : ZOTERO_WRITE_LIMIT,
+			},
+		)
+		if r.status != 200:
+			raise ZoteroAPIError(f'could not fetch item keys: {r.status} {r.data.decode("utf-8")}')
+		existing.update(r.data.decode('utf-8').split())
+	return existing
+
+
+def zotero_plan(
+		data_json_path : str = DATA_EXPORT_PATH,
+		plan_path : str = ZOTERO_PLAN_FILE,
+		zotero_manager : Optional[ZoteroManager] = None,
+		export_func : Union[Callable[[List[ClippingsItem]], str], str, CompiledTemplate] = ClippingsItem_lst_md,
+	) -> dict:
+	"""compute what uploading `data_json_path` would do, and save the plan to `plan_path`
+
+	renders the notes for every paired book to `ZOTERO_EXPORT_DIR`, but does not write
+	anything to Zotero. books which are not yet paired with a Zotero item are listed as
+	`unresolved` -- pair them with `zotero_upload` first
+
+	### Parameters:
+	 - `data_json_path : str`
+	   (defaults to `DATA_EXPORT_PATH`)
+	 - `plan_path : str`
+	   (defaults to `ZOTERO_PLAN_FILE`)
+	 - `zotero_manager : Optional[ZoteroManager]`
+	 - `export_func : Union[Callable[[List[ClippingsItem]], str], str, CompiledTemplate]`
+	   function or template used to render the notes
+	   (defaults to `ClippingsItem_lst_md`)
+
+	### Returns:
+	 - `dict`
+	   the plan
+	"""
+
+	if zotero_manager is None:
+		zotero_manager = ZoteroManager()
+	if isinstance(export_func, str):
+		export_func = get_template(export_func)
+	extension : str = export_func.extension if isinstance(export_func, CompiledTemplate) else '.md'
+
+	with open(data_json_path, 'r') as f:
+		data : Dict[str, List[ClippingsItem]] = {
+			k : [ ClippingsItem(**x) for x in v ]
+			for k, v in json.load(f).items()
+		}
+
+	# local decisions and exports, no requests
+	cache : dict = zk_cache_load()
+	actions : List[dict] = list()
+	for title, items in data.items():
+		cache_key : ZKCacheKey = ZKCacheKey(items[0].title, items[0].author)
+		book : str = ZKCacheKey_tostr(cache_key)
+		cache_value = cache.get(book, None)
+
+		if cache_value == -1:
+			actions.append({'book' : book, 'action' : 'ignore'})
+			continue
+		if not isinstance(cache_value, str):
+			actions.append({'book' : book, 'action' : 'unresolved'})
+			continue
+
+		fname_export : str = ZOTERO_EXPORT_DIR + ClippingsItem_to_filename(cache_key) + extension
+		with open(fname_export, 'w') as f:
+			if isinstance(export_func, CompiledTemplate):
+				export_func.render_to(items, f)
+			else:
+				f.write(export_func(items))
+		md5, sha256 = _file_hashes(fname_export)
+
+		actions.append({
+			'book' : book,
+			'action' : None,
+			'parent' : cache_value,
+			'file' : fname_export,
+			'title' : 'kindleclip_' + os.path.basename(fname_export),
+			'md5' : md5,
+			'hash' : sha256,
+		})
+
+	# bulk-fetch the remote state
+	to_upload : List[dict] = [ x for x in actions if x['action'] is None ]
+	existing_parents : Set[ZoteroKey] = fetch_existing_keys(zotero_manager, [ x['parent'] for x in to_upload ])
+	existing_attachments : Dict[Tuple[ZoteroKey, str], List[dict]] = fetch_existing_attachments(zotero_manager)
+
+	for act in to_upload:
+		old : List[dict] = existing_attachments.get((act['parent'], act['title']), list())
+		act['old'] = [ {'key' : x['key'], 'version' : x['version']} for x in old ]
+		if act['parent'] not in existing_parents:
+			act['action'] = 'missing_parent'
+		elif not old:
+			act['action'] = 'create'
+		elif (len(old) == 1) and (old[0]['data'].get('md5', None) == act['md5']):
+			act['action'] = 'skip'
+		else:
+			act['action'] = 'replace'
+
+	plan : dict = {
+		'created' : int(time.time()),
+		'library_url' : zotero_manager.get_library_url(),
+		'actions' : actions,
+	}
+	with open(plan_path, 'w') as f:
+		json.dump(plan, f, indent = '\t')
+
+	# summary
+	counts : Dict[str, int] = dict()
+	for act in actions:
+		counts[act['action']] = counts.get(act['action'], 0) + 1
+		if act['action'] in ('create', 'replace', 'missing_parent', 'unresolved'):
+			print(f"  {act['action']:>14} : {act['book']}")
+	print(f'# plan saved to {plan_path}: {counts}')
+
+	return plan
+
+
+def zotero_apply(
+		plan_path : str = ZOTERO_PLAN_FILE,
+		zotero_manager : Optional[ZoteroManager] = None,
+		n_workers : int = 4,
+		journal_path : Optional[str] = ZOTERO_UPLOAD_JOURNAL_FILE,
+	) -> None:
+	"""execute a plan saved by `zotero_plan`, with no further lookups
+
+	actions whose export file changed since planning are skipped as stale. new attachments
+	are created in batches and uploaded in parallel, then old ones are deleted, each only
+	if it is still at the version seen when planning.
+
+	progress is recorded in the upload journal, see `util.journal`. when re-running a plan
+	after an interruption, books already done are skipped, books already uploaded only
+	have their old attachments deleted, and attachments left over by the interrupted run
+	are deleted as well
+
+	### Parameters:
+	 - `plan_path : str`
+	   (defaults to `ZOTERO_PLAN_FILE`)
+	 - `zotero_manager : Optional[ZoteroManager]`
+	 - `n_workers : int`
+	   number of parallel file uploads
+	   (defaults to `4`)
+	 - `journal_path : Optional[str]`
+	   (defaults to `ZOTERO_UPLOAD_JOURNAL_FILE`)
+	"""
+
+	if zotero_manager is None:
+		zotero_manager = ZoteroManager()
+
+	with open(plan_path, 'r') as f:
+		plan : dict = json.load(f)
+
+	if plan['library_url'] != zotero_manager.get_library_url():
+		raise ValueError(f"plan is for library {plan['library_url']}, but the current library is {zotero_manager.get_library_url()}")
+
+	# check for stale actions
+	todo : List[dict] = list()
+	for act in plan['actions']:
+		if act['action'] not in ('create', 'replace'):
+			continue
+		if (not os.path.exists(act['file'])) or (_file_hashes(act['file'])[0] != act['md5']):
+			print(f"  WARNING: {act['file']} changed since the plan was made, skipping \"{act['book']}\"")
+			continue
+		todo.append(act)
+
+	journal : Optional[UploadJournal] = UploadJournal(journal_path) if journal_path is not None else None
+	try:
+		# resume from the journal
+		to_create : List[dict] = list()
+		uploaded : List[dict] = list()
+		for act in todo:
+			if journal is not None:
+				if journal.is_done(act['book'], act['hash'], act['parent']):
+					print(f"  {'done':>8} : {act['book']}")
+					continue
+				pending : Optional[dict] = journal.pending(act['book'])
+				if pending is not None:
+					resumed : bool = (
+						(pending['step'] == 'uploaded')
+						and (pending['hash'] == act['hash'])
+						and (pending['parent'] == act['parent'])
+					)
+					if resumed:
+						act['new_key'] = pending['key']
+					# the interrupted run may have left attachments which are not in the plan
+					_add_stray_attachments(zotero_manager, act)
+					if resumed:
+						print(f"  {'resumed':>8} : {act['book']} -> {act['new_key']}")
+						uploaded.append(act)
+						continue
+			to_create.append(act)
+
+		if not (to_create or uploaded):
+			print('# nothing to apply')
+			return
+
+		for act in to_create:
+			if journal is not None:
+				journal.record(act['book'], 'begin', parent = act['parent'], hash = act['hash'])
+
+		# create all attachment items, batched
+		created : Dict[str, dict] = zotero_manager.client.create_items([
+			zotero_manager.attachment_metadata(act['file'], act['parent'])
+			for act in to_create
+		]) if to_create else dict()
+
+		# upload the files in parallel
+		def _upload(idx : int) -> Tuple[int, str]:
+			res : dict = created[str(idx)]
+			if 'failed' in res:
+				return (idx, 'failure')
+			try:
+				return (idx, zotero_manager.client.upload_file(res['key'], to_create[idx]['file']))
+			except ZoteroAPIError as e:
+				print(f"  error uploading \"{to_create[idx]['book']}\": {e}")
+				return (idx, 'error')
+
+		with concurrent.futures.ThreadPoolExecutor(n_workers) as pool:
+			for idx, status in pool.map(_upload, range(len(to_create))):
+				act : dict = to_create[idx]
+				print(f"  {act['action']:>8} : {act['book']} -> {status}")
+				if status in ('success', 'unchanged'):
+					act['new_key'] = created[str(idx)]['key']
+					uploaded.append(act)
+					if journal is not None:
+						journal.record(act['book'], 'uploaded', key = act['new_key'])
+
+		# delete the replaced attachments one by one, each with the version seen when
+		# planning, so an attachment modified in Zotero since then is not deleted
+		old_items : List[dict] = [
+			old
+			for act in uploaded
+			for old in act['old']
+			if old['key'] != act['new_key']
+		]
+		if old_items:
+			with concurrent.futures.ThreadPoolExecutor(n_workers) as pool:
+				for item, ok in zip(old_items, pool.map(lambda x : zotero_manager.client.delete_item(x['key'], x['version']), old_items)):
+					if not ok:
+						print(f"  WARNING: attachment {item['key']} was modified in Zotero, not deleting it")
+
+		if journal is not None:
+			for act in uploaded:
+				journal.record(act['book'], 'done', key = act['new_key'])
+			journal.compact()
+	finally:
+		if journal is not None:
+			journal.close()
+
+	print(f'# applied {len(uploaded)} of {len(todo)} uploads')
+
+
+def _add_stray_attachments(zotero_manager : ZoteroManager, act : dict) -> None:
+	"""add attachments of `act` which are neither planned for deletion nor its new attachment to `act['old']`"""
+	known : Set[str] = { x['key'] for x in act['old'] } | { act.get('new_key', None) }
+	for item in zotero_manager.find_attachments(act['title'], act['parent']):
+		if item['key'] not in known:
+			act['old'].append({'key' : item['key'], 'version' : item['version']})